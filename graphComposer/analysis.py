@@ -0,0 +1,165 @@
+import numpy as np
+from scipy.sparse import csr_matrix, identity, vstack
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+from scipy.sparse.linalg import bicgstab, spsolve
+from blend import edge_list
+
+def transition_matrix(g, normalize=True):
+    """
+    > Export the edges of a graph as a SciPy CSR matrix with one row and one column per state. The
+    matrix is made straight from the graph's edge arrays, so it costs a few NumPy passes over the edges
+
+    :param g: the graph
+    :param normalize: divide every row by its total so the rows hold transition probabilities, defaults
+    to True; with False the matrix holds the edge counts (optional)
+    :return: A scipy.sparse.csr_matrix of shape (states, states)
+    """
+    sources, targets, counts = edge_list(g)
+    states = len(g._degrees)
+    degrees = np.bincount(sources, minlength=states)
+    indptr = np.concatenate(([0], np.cumsum(degrees)))
+    if normalize:
+        totals = np.bincount(sources, weights=counts, minlength=states)
+        counts = counts / totals[sources]
+    return csr_matrix((counts, targets, indptr), shape=(states, states))
+
+def start_distribution(g):
+    """
+    It returns the probability of each state to be picked by Graph.random_vertex, which is where a
+    composition starts (and where compose_batch restarts a chain that reached a dead end)
+    :param g: the graph
+    :return: An array with one probability per state
+    """
+    sources, _, counts = edge_list(g)
+    totals = np.bincount(sources, weights=counts, minlength=len(g._degrees))
+    return totals / totals.sum()
+
+def stationary_distribution(g, matrix=None, damping=1.0, tol=1e-10, max_iterations=1000):
+    """
+    > Work out the share of the time a long composition spends in each state, by power iteration. A
+    chain that reaches a dead end starts again from Graph.random_vertex, so the probability that flows
+    into dead ends is put back in proportion to the start distribution. With a damping below 1 every
+    step also restarts with probability 1 - damping, like PageRank, which makes the iteration converge
+    faster on graphs with long cycles
+
+    :param g: the graph
+    :param matrix: the transition_matrix of the graph, if it was already made (optional)
+    :param damping: the probability of following an edge instead of restarting, defaults to 1 (optional)
+    :param tol: stop when the distribution moves less than this in L1 norm, defaults to 1e-10 (optional)
+    :param max_iterations: the most iterations, defaults to 1000 (optional)
+    :return: A tuple of (distribution over the states, number of iterations)
+    """
+    matrix = transition_matrix(g) if matrix is None else matrix
+    start = start_distribution(g)
+    dead = np.diff(matrix.indptr) == 0
+    transposed = matrix.T.tocsr()
+    distribution = start.copy()
+    for iteration in range(1, max_iterations + 1):
+        following = transposed @ distribution
+        restart = distribution[dead].sum() * damping + (1 - damping)
+        following = damping * following + restart * start
+        change = np.abs(following - distribution).sum()
+        distribution = following
+        if change < tol:
+            break
+    return distribution, iteration
+
+def word_distribution(g, state_distribution):
+    """
+    It adds up a distribution over the states of a graph into a distribution over the words they end on
+    :param g: the graph
+    :param state_distribution: an array with one probability per state
+    :return: A dictionary that maps words to probabilities, most likely first
+    """
+    if g.order == 1:
+        last_words = np.arange(len(g._degrees))
+    else:
+        last_words = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, g.order)[:, -1]
+    probabilities = np.bincount(last_words, weights=state_distribution, minlength=len(g.words))
+    ordered = np.argsort(-probabilities, kind='stable')
+    return {g.words[index]: float(probabilities[index]) for index in ordered if probabilities[index] > 0}
+
+def strongly_connected_components(g, matrix=None):
+    """
+    It splits the states of a graph into strongly connected components: sets of states that can all
+    reach each other
+    :param g: the graph
+    :param matrix: the transition_matrix of the graph, if it was already made (optional)
+    :return: A tuple of (number of components, array with the component of every state)
+    """
+    matrix = transition_matrix(g, normalize=False) if matrix is None else matrix
+    return connected_components(matrix, directed=True, connection='strong')
+
+def reachable_states(g, value, matrix=None):
+    """
+    It finds every state a composition can reach from a vertex
+    :param g: the graph
+    :param value: a word, or a tuple of `order` words when order > 1, that the graph knows (else a
+    KeyError is raised)
+    :param matrix: the transition_matrix of the graph, if it was already made (optional)
+    :return: An array of booleans, one per state
+    """
+    matrix = transition_matrix(g, normalize=False) if matrix is None else matrix
+    index = g._find_state(value)
+    if index is None or index >= matrix.shape[0]:
+        raise KeyError(f'{value!r} is not a state of the graph')
+    reached = np.zeros(matrix.shape[0], dtype=bool)
+    reached[breadth_first_order(matrix, index, directed=True, return_predecessors=False)] = True
+    return reached
+
+def expected_chain_length(g, matrix=None, direct_limit=50000, tol=1e-10):
+    """
+    > Work out for every state the expected number of steps a composition takes from it before it hits
+    a dead end (a state without successors): 0 for a dead end, and 1 plus the average over the
+    successors otherwise. That is one sparse linear system, (I - P) x = 1, over the states that reach a
+    dead end for sure, solved exactly for small graphs and with BiCGSTAB for big ones, where a direct
+    solver would need far too much memory. A state from which the chain can get caught in a part of the
+    graph without dead ends gets infinity
+
+    :param g: the graph
+    :param matrix: the transition_matrix of the graph, if it was already made (optional)
+    :param direct_limit: the most states to solve for exactly, defaults to 50000 (optional)
+    :param tol: the relative tolerance of the iterative solver, defaults to 1e-10 (optional)
+    :return: An array with the expected number of steps from every state
+    """
+    matrix = transition_matrix(g) if matrix is None else matrix
+    states = matrix.shape[0]
+    dead = np.diff(matrix.indptr) == 0
+    reversed_edges = matrix.T.tocsr()
+
+    # the states that cannot reach a dead end, then every state that can reach one of those
+    reaches_dead = reached_backwards(reversed_edges, dead)
+    endless = reached_backwards(reversed_edges, ~reaches_dead)
+    finite = ~endless & ~dead
+    lengths = np.full(states, np.inf)
+    lengths[dead] = 0
+    if finite.any():
+        inner = matrix[finite][:, finite]
+        system = identity(inner.shape[0], format='csr') - inner
+        ones = np.ones(inner.shape[0])
+        if inner.shape[0] <= direct_limit:
+            lengths[finite] = spsolve(system.tocsc(), ones)
+        else:
+            solution, info = bicgstab(system, ones, rtol=tol, maxiter=10 * inner.shape[0])
+            if info:
+                raise ArithmeticError(f'The expected chain lengths did not converge ({info})')
+            lengths[finite] = solution
+    return lengths
+
+def reached_backwards(reversed_edges, seeds):
+    """
+    It marks every state that has a path to one of the seed states, with one breadth first search from
+    an extra state that has an edge to every seed
+    :param reversed_edges: the transition matrix, transposed, as a CSR matrix
+    :param seeds: an array of booleans, one per state
+    :return: An array of booleans, one per state
+    """
+    states = len(seeds)
+    if not seeds.any():
+        return seeds.copy()
+    seed_row = csr_matrix((np.ones(seeds.sum()), np.flatnonzero(seeds), [0, seeds.sum()]), shape=(1, states))
+    extended = vstack([reversed_edges, seed_row], format='csr')
+    extended.resize((states + 1, states + 1))
+    reached = np.zeros(states + 1, dtype=bool)
+    reached[breadth_first_order(extended, states, directed=True, return_predecessors=False)] = True
+    return reached[:states]
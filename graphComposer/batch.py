@@ -0,0 +1,212 @@
+import numpy as np
+
+def edge_arrays(g):
+    """
+    It makes sure every edge of a graph is in its edge arrays and returns NumPy views of those arrays.
+    The views of the targets and counts share memory with the graph, so they are only good until the
+    graph changes
+
+    :param g: the graph
+    :return: A tuple of (starts, degrees, targets, counts) arrays
+    """
+    g.generate_probability_mappings()
+    g._add_rows()
+    return (np.frombuffer(g._starts, dtype=np.uint64).astype(np.int64),
+            np.frombuffer(g._degrees, dtype=np.uint32).astype(np.int64),
+            np.frombuffer(g._targets, dtype=np.uint32),
+            np.frombuffer(g._counts, dtype=g._count_type()))
+
+def alias_table(counts):
+    """
+    It builds the alias table of one row with Vose's method. Column k of the table keeps its own edge
+    with probability `probabilities[k]` and otherwise takes edge `aliases[k]`
+
+    :param counts: a list with the counts of the edges of the row
+    :return: A tuple of (probabilities, aliases) lists with one entry per edge
+    """
+    degree = len(counts)
+    probabilities = [1.0] * degree
+    aliases = list(range(degree))
+    total = sum(counts)
+    scaled = [count * degree / total for count in counts]
+    small = [k for k, p in enumerate(scaled) if p < 1]
+    large = [k for k, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] += scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    # whatever is left over keeps its own edge, which is right up to rounding error
+    return probabilities, aliases
+
+def start_weights(starts, degrees, counts):
+    """
+    It adds up the counts of the edges leaving each vertex
+
+    :param starts: the first edge slot of each vertex
+    :param degrees: the number of edges of each vertex
+    :param counts: the count of each edge slot
+    :return: An array with the total outgoing count of each vertex.
+    """
+    total_type = np.float64 if counts.dtype.kind == 'f' else np.int64
+    running = np.concatenate(([0], np.cumsum(counts, dtype=total_type)))
+    return running[starts + degrees] - running[starts]
+
+# The BatchSampler class prepares everything compose_batch needs from a graph once: the edge arrays
+# with the alias tables of every row laid out along them (one entry per edge slot), the running total
+# of the row totals for picking start states, and the vocabulary as a NumPy array. A batch then only
+# costs its own draws, with nothing that grows with the graph. It works on a copy of the arrays, so it
+# keeps describing the graph as it was when the sampler was made
+class BatchSampler:
+    def __init__(self, g):
+        """
+        :param g: the graph
+        """
+        self.g = g
+        self.order = g.order
+        starts, degrees, targets, counts = edge_arrays(g)
+        self.starts = starts
+        self.degrees = degrees
+        self.targets = targets.astype(np.int64)
+        # a row of one edge needs no table: probability 1 of keeping column 0
+        self.alias_prob = np.ones(len(targets), dtype=np.float32)
+        self.alias_index = np.zeros(len(targets), dtype=np.int64)
+        for index in np.flatnonzero(degrees > 1).tolist():
+            start, end = starts[index], starts[index] + degrees[index]
+            self.alias_prob[start:end], self.alias_index[start:end] = alias_table(counts[start:end].tolist())
+        self.cum_totals = np.cumsum(start_weights(starts, degrees, counts))
+        if self.order == 1:
+            self.state_words = np.arange(len(degrees), dtype=np.uint32).reshape(-1, 1)
+        else:
+            self.state_words = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, self.order).copy()
+        self.last_words = self.state_words[:, -1].copy()
+        self.vocabulary = np.array(list(g.words), dtype=object)
+
+    def random_states(self, size, rng):
+        """
+        It picks random states, each as likely as Graph.random_vertex would pick it
+        :param size: the number of states
+        :param rng: a numpy.random.Generator
+        :return: An array of state ids
+        """
+        cum_totals = self.cum_totals
+        return np.minimum(np.searchsorted(cum_totals, rng.random(size) * cum_totals[-1], side='right'),
+                          len(cum_totals) - 1)
+
+    def step(self, state, rng):
+        """
+        It moves every chain to a random successor of its state, restarting the chains that are at a
+        vertex without neighbors
+        :param state: an array of state ids, changed in place
+        :param rng: a numpy.random.Generator
+        :return: The array of next state ids
+        """
+        dead = self.degrees[state] == 0
+        if dead.any():
+            state[dead] = self.random_states(dead.sum(), rng)
+        start = self.starts[state]
+        u = rng.random(len(state)) * self.degrees[state]
+        picked = u.astype(np.int64)
+        slot = start + picked
+        alias = start + self.alias_index[slot]
+        slot = np.where(u - picked < self.alias_prob[slot], slot, alias)
+        return self.targets[slot]
+
+    def sample(self, n, words=None, length=50, rng=None):
+        """
+        > Generate n compositions at once. All n chains take a step together: one call to the random
+        number generator gives every chain its uniform number, and the alias tables turn those
+        numbers into next states with a handful of NumPy operations, so the Python loop runs `length`
+        times instead of n * `length` times. A chain that reaches a vertex without neighbors (the end
+        of the corpus) starts over from a random vertex instead of failing
+
+        :param n: the number of compositions
+        :param words: a list of words to pick the starting points from, or None to start from random
+        vertices of the graph; a starting point the graph does not know raises KeyError (optional)
+        :param length: the length of each composition, defaults to 50 (optional)
+        :param rng: a numpy.random.Generator, defaults to a new one (optional)
+        :return: A list of n lists of words
+        """
+        rng = rng or np.random.default_rng()
+        g = self.g
+        order = self.order
+        if words is None:
+            state = self.random_states(n, rng)
+        else:
+            positions = rng.integers(0, len(words) - order + 1, n)
+            values = [words[p] if order == 1 else tuple(words[p:p + order]) for p in positions]
+            found = [g._find_state(value) for value in values]
+            for value, index in zip(values, found):
+                if index is None or index >= len(self.degrees):
+                    raise KeyError(f'{value!r} is not a state of the graph the sampler was made from')
+            state = np.array(found, dtype=np.int64)
+
+        out = np.empty((n, length), dtype=np.uint32)
+        prefix = min(order - 1, length)
+        out[:, :prefix] = self.state_words[state, :prefix]
+        for column in range(prefix, length):
+            out[:, column] = self.last_words[state]
+            if column + 1 == length:
+                break
+            state = self.step(state, rng)
+        return self.vocabulary[out].tolist()
+
+def compose_batch(g, n, words=None, length=50, rng=None):
+    """
+    It generates n compositions at once with a BatchSampler made for the call. Code that draws many
+    batches from the same graph, like the server, should keep one BatchSampler and call its `sample`
+
+    :param g: the graph
+    :param n: the number of compositions
+    :param words: a list of words to pick the starting points from, or None to start from random
+    vertices of the graph; a starting point the graph does not know raises KeyError (optional)
+    :param length: the length of each composition, defaults to 50 (optional)
+    :param rng: a numpy.random.Generator, defaults to a new one (optional)
+    :return: A list of n lists of words
+    """
+    return BatchSampler(g).sample(n, words, length, rng)
+
+def top_k_batch(g, values, k):
+    """
+    > The k most likely next words after many vertices at once (see Graph.top_k). The rows of the graph
+    are sorted by count, so the answer is the first k slots of every row, gathered with one NumPy index.
+    Only the rows of the values are read, so a call costs O(len(values) * k) however big the graph is
+
+    :param g: the graph
+    :param values: a list of words, or of tuples of `order` words when order > 1
+    :param k: the number of words per value
+    :return: A list with a list of up to k (word, probability) pairs per value, empty for a value the
+    graph does not know
+    """
+    g.generate_probability_mappings()
+    if g.order == 1:
+        found = [g.word_ids.get(value) for value in values]
+    else:
+        found = [g._state_ids.get(key) if key is not None else None
+                 for key in map(g._state_key, values)]
+    rows = len(g._degrees)
+    known = np.array([index is not None and index < rows for index in found], dtype=bool)
+    states = np.array([index if ok else 0 for index, ok in zip(found, known.tolist())], dtype=np.int64)
+
+    # views of the graph's arrays, indexed only at the states asked for
+    counts = np.frombuffer(g._counts, dtype=g._count_type())
+    total_type = np.float64 if counts.dtype.kind == 'f' else np.uint64
+    starts = np.frombuffer(g._starts, dtype=np.uint64)[states].astype(np.int64) if rows else states
+    degrees = np.frombuffer(g._degrees, dtype=np.uint32)[states] if rows else states
+    totals = np.frombuffer(g._totals, dtype=total_type)[states] if rows else states
+
+    columns = np.arange(k)
+    taken = known[:, None] & (columns < degrees[:, None])
+    slots = np.where(taken, starts[:, None] + columns, 0)
+    next_states = np.frombuffer(g._targets, dtype=np.uint32)[slots] if len(g._targets) else slots
+    if g.order > 1:
+        next_states = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, g.order)[next_states, -1]
+    probabilities = (counts[slots] if len(counts) else slots) / np.maximum(totals, 1e-300)[:, None]
+    words = g.words
+    return [[(words[word], p) for word, p in zip(row_words[:n], row_p[:n])]
+            for row_words, row_p, n in zip(next_states.tolist(), probabilities.tolist(), taken.sum(1).tolist())]
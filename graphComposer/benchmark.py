@@ -0,0 +1,397 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from itertools import accumulate
+from compose import compose, get_words_from_text, ingest, make_graph, song_files
+from graph import Graph
+
+def time_it(function, repeat=3):
+    """
+    It runs a function a few times and returns the fastest wall time
+
+    :param function: the function to time, called with no arguments
+    :param repeat: how many times to run it, defaults to 3 (optional)
+    :return: The best time in seconds.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_sampling(text_path, steps=100000):
+    """
+    > Walk the graph of a text for a number of steps, once with the graph's own sampling and
+    once with `random.choices` over each vertex's neighbor lists (the way `Vertex.next_word` used to do
+    it), and print how long each walk takes
+
+    :param text_path: the path to the text file
+    :param steps: the number of words to draw in each walk, defaults to 100000 (optional)
+    """
+    words = get_words_from_text(text_path)
+    g = make_graph(words)
+    start = g.get_vertex(words[0])
+
+    def graph_walk():
+        vertex = start
+        for _ in range(steps):
+            if not g._degrees[vertex.index]:
+                vertex = start
+            vertex = vertex.next_word()
+
+    rows = {index: (vertex.neighbors, vertex.neighbors_weights)
+            for index, vertex in ((i, g.get_vertex(w)) for i, w in enumerate(g.words))}
+
+    def choices_walk():
+        vertex = start
+        for _ in range(steps):
+            neighbors, weights = rows[vertex.index]
+            if not neighbors:
+                vertex = start
+                neighbors, weights = rows[vertex.index]
+            vertex = random.choices(neighbors, weights=weights)[0]
+
+    hub = max(range(len(g.words)), key=lambda i: g._degrees[i] if i < len(g._degrees) else 0)
+    print(f'{text_path}: {len(words)} words, {len(g.words)} vertices, {len(g._targets)} edges')
+    print(f'largest row: {g.words[hub]!r} with {g._degrees[hub]} neighbors')
+    choices_time = time_it(choices_walk)
+    graph_time = time_it(graph_walk)
+    print(f'random.choices walk: {choices_time:.3f}s ({steps / choices_time:,.0f} words/s)')
+    print(f'graph walk:          {graph_time:.3f}s ({steps / graph_time:,.0f} words/s)')
+    print(f'speedup: {choices_time / graph_time:.1f}x')
+
+def measure_build(words, order):
+    """
+    It builds the graph of a list of words and measures how long it takes and how much memory the
+    finished graph holds
+
+    :param words: a list of words
+    :param order: the order of the graph
+    :return: A tuple of (seconds, bytes, number of states, number of edges).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    g = make_graph(words, order)
+    seconds = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, size, len(g), len(g._targets) - g._garbage
+
+def bench_orders(text_path, orders=(1, 2, 3, 4), fractions=(0.25, 0.5, 1.0)):
+    """
+    > Build order 1 to 4 graphs over growing prefixes of a text and print build time and memory, so we
+    can check that both grow roughly linearly with the size of the corpus
+
+    :param text_path: the path to the text file
+    :param orders: the orders to build, defaults to (1, 2, 3, 4) (optional)
+    :param fractions: the prefixes of the text to build from, defaults to (0.25, 0.5, 1.0) (optional)
+    """
+    words = get_words_from_text(text_path)
+    print(f'{text_path}: {len(words)} words')
+    print(f'{"order":>5} {"words":>8} {"states":>8} {"edges":>8} {"seconds":>8} {"MB":>7} {"B/word":>7}')
+    for order in orders:
+        for fraction in fractions:
+            prefix = words[:int(len(words) * fraction)]
+            seconds, size, states, edges = measure_build(prefix, order)
+            print(f'{order:>5} {len(prefix):>8} {states:>8} {edges:>8} {seconds:>8.3f} '
+                  f'{size / 1e6:>7.2f} {size / len(prefix):>7.1f}')
+
+def edge_table(g):
+    """
+    It lists the edges of a graph by value, so graphs with different ids can be compared
+    :param g: the graph
+    :return: A dictionary that maps (source value, target value) pairs to counts
+    """
+    return {(g._state_value(source), g._state_value(target)): count
+            for source in range(len(g)) for target, count in g._row(source)}
+
+def check_snapshot_update(text_path, orders=(1, 2, 3), split=0.5):
+    """
+    > Save the graph of the first part of a text, load it (mapped and read in), add the rest of the
+    text with `update` and check that the result has the same edges as the graph of the whole text,
+    including the edges that cross from one part to the other
+
+    :param text_path: the path to the text file
+    :param orders: the orders to check, defaults to (1, 2, 3) (optional)
+    :param split: the share of the text in the saved graph, defaults to 0.5 (optional)
+    :return: True if every order matched
+    """
+    words = get_words_from_text(text_path)
+    cut = int(len(words) * split)
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'graph.snapshot')
+        for order in orders:
+            expected = edge_table(make_graph(words, order))
+            make_graph(words[:cut], order).save(path)
+            for mmap in (True, False):
+                g = Graph.load(path, mmap)
+                g.update(words[cut:])
+                same = edge_table(g) == expected
+                ok &= same
+                print(f'order {order} {"mapped" if mmap else "read"}: {"ok" if same else "DIFFERENT"}')
+    return ok
+
+def bench_ingest(worker_counts=None, repeat=3):
+    """
+    > Build one graph from the songs of every artist in `songs/` with different numbers of worker
+    processes and print the wall time and speedup of each
+
+    :param worker_counts: the numbers of processes to try, defaults to 1, 2, 4, ... up to the number of
+    CPUs (optional)
+    :param repeat: how many times to build with each number, defaults to 3 (optional)
+    """
+    paths = [path for artist in sorted(os.listdir('songs')) if artist != '.DS_Store'
+             for path in song_files(artist)]
+    if worker_counts is None:
+        cpus = os.cpu_count() or 1
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= cpus:
+            worker_counts.append(worker_counts[-1] * 2)
+    print(f'songs/: {len(paths)} files')
+    base = None
+    for workers in worker_counts:
+        seconds = time_it(lambda: ingest(paths, 1, workers), repeat)
+        base = base or seconds
+        print(f'{workers:>3} workers: {seconds:.3f}s (speedup {base / seconds:.2f}x)')
+
+def synthetic_corpus(path, words, vocabulary=None, seed=0):
+    """
+    It writes a text of random words whose frequencies follow Zipf's law, like the words of real text,
+    with a line break every 12 words and a section tag every 40 lines
+
+    :param path: the file to write
+    :param words: the number of words
+    :param vocabulary: the number of different words, defaults to a tenth of the words (optional)
+    :param seed: the random seed, defaults to 0 (optional)
+    """
+    rng = random.Random(seed)
+    vocabulary = vocabulary or max(words // 10, 10)
+    cum_weights = list(accumulate(1 / rank for rank in range(1, vocabulary + 1)))
+    with open(path, 'w') as f:
+        for line in range(0, words, 12):
+            if line % 480 == 0:
+                f.write('[Verse]\n')
+            ranks = rng.choices(range(vocabulary), cum_weights=cum_weights, k=min(12, words - line))
+            f.write(' '.join(f'w{rank}' for rank in ranks) + '\n')
+
+def count_edges_only(words, order=1):
+    """
+    It does the counting half of `make_graph` and leaves the counts pending, so that
+    `generate_probability_mappings` can be measured on its own
+
+    :param words: a list of words
+    :param order: the order of the graph, defaults to 1 (optional)
+    :return: A graph whose edges are not folded into its arrays yet
+    """
+    g = Graph(order)
+    pending = g._pending
+    previous = None
+    for index in range(order - 1, len(words)):
+        state = words[index] if order == 1 else tuple(words[index - order + 1:index + 1])
+        vertex = g.get_vertex(state).index
+        if previous is not None:
+            key = previous << 32 | vertex
+            pending[key] = pending.get(key, 0) + 1
+        previous = vertex
+    return g
+
+def corpus_cases(paths, order=1, compositions=200):
+    """
+    It lists the hot paths to measure on a corpus, each as a (name, setup, run) triple: setup prepares
+    the input outside of the measurement and run is the part that is measured
+
+    :param paths: the files of the corpus
+    :param order: the order of the graphs, defaults to 1 (optional)
+    :param compositions: how many 100 word compositions the compose case makes, defaults to 200 (optional)
+    :return: A list of cases
+    """
+    def read():
+        return [word for path in paths for word in get_words_from_text(path)]
+
+    def compose_many(state):
+        words, g = state
+        for _ in range(compositions):
+            compose(g, words, 100)
+
+    return [
+        ('get_words_from_text', lambda: None, lambda _: read()),
+        ('make_graph', read, lambda words: make_graph(words, order)),
+        ('generate_probability_mappings', lambda: count_edges_only(read(), order),
+         lambda g: g.generate_probability_mappings()),
+        ('compose', lambda: (lambda words: (words, make_graph(words, order)))(read()), compose_many),
+    ]
+
+def measure(setup, run):
+    """
+    > Measure one case in the current process: the wall time of `run`, how much the peak resident set
+    size grew while it ran, and in a second, traced run the peak bytes and the number of memory blocks
+    allocated by Python. The traced run is separate because tracing slows everything down
+
+    :param setup: a function that prepares the input of run
+    :param run: the function to measure, called with what setup returned
+    :return: A dictionary of measurements
+    """
+    state = setup()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    run(state)
+    seconds = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    state = setup()
+    tracemalloc.start()
+    result = run(state)
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    alloc_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del result
+    return {'seconds': seconds, 'peak_rss_kb': rss_after, 'rss_growth_kb': rss_after - rss_before,
+            'alloc_peak_bytes': alloc_peak, 'alloc_live_blocks': alloc_blocks}
+
+def _measure_child(connection, paths, order, case_name):
+    for name, setup, run in corpus_cases(paths, order):
+        if name == case_name:
+            connection.send(measure(setup, run))
+    connection.close()
+
+def measure_in_child(paths, order, case_name):
+    """
+    It measures one case in a fresh process, so that the peak RSS of one case does not hide the next
+
+    :param paths: the files of the corpus
+    :param order: the order of the graphs
+    :param case_name: the name of the case, as listed by corpus_cases
+    :return: A dictionary of measurements
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure_child, args=(sender, paths, order, case_name))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+def run_suite(sizes=(10000, 100000, 1000000), orders=(1,), include_bundled=True):
+    """
+    > Measure every hot path of graphComposer on synthetic corpora of the given sizes and on the
+    bundled `songs/` and `texts/` data, and return the results with enough about the machine and the
+    code to compare runs later
+
+    :param sizes: the numbers of words of the synthetic corpora, defaults to 10k, 100k and 1M (optional)
+    :param orders: the graph orders to measure, defaults to (1,) (optional)
+    :param include_bundled: also measure `songs/` and `texts/`, defaults to True (optional)
+    :return: A dictionary that can be written as JSON
+    """
+    corpora = []
+    directory = tempfile.mkdtemp(prefix='graphcomposer-bench-')
+    for size in sizes:
+        path = os.path.join(directory, f'synthetic_{size}.txt')
+        synthetic_corpus(path, size)
+        corpora.append((f'synthetic_{size}', [path]))
+    if include_bundled:
+        corpora.append(('songs', [path for artist in sorted(os.listdir('songs')) if artist != '.DS_Store'
+                                  for path in sorted(song_files(artist))]))
+        corpora.append(('texts', sorted(os.path.join('texts', name) for name in os.listdir('texts'))))
+
+    results = []
+    for corpus, paths in corpora:
+        words = sum(1 for path in paths for _ in get_words_from_text(path))
+        for order in orders:
+            for name, _, _ in corpus_cases(paths, order):
+                result = {'corpus': corpus, 'words': words, 'order': order, 'case': name}
+                result.update(measure_in_child(paths, order, name))
+                results.append(result)
+                print(f"{corpus:>18} k={order} {name:<30} {result['seconds']:>8.3f}s "
+                      f"{result['rss_growth_kb'] / 1024:>8.1f} MB rss "
+                      f"{result['alloc_peak_bytes'] / 1e6:>8.1f} MB traced")
+    for path in os.listdir(directory):
+        os.remove(os.path.join(directory, path))
+    os.rmdir(directory)
+
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = ''
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': revision,
+                     'python': platform.python_version(), 'machine': platform.machine(),
+                     'cpus': os.cpu_count()},
+            'results': results}
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    > Compare two result files of `run_suite` case by case and list the measurements that got worse by
+    more than `tolerance` (10% by default)
+
+    :param baseline: the results to compare against
+    :param current: the new results
+    :param tolerance: the relative change that counts as a regression, defaults to 0.1 (optional)
+    :return: A list of (corpus, order, case, measurement, old, new) tuples
+    """
+    def key(result):
+        return result['corpus'], result['order'], result['case']
+
+    old = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = old.get(key(result))
+        if before is None:
+            continue
+        for measurement in ('seconds', 'alloc_peak_bytes', 'rss_growth_kb'):
+            # tiny values are all noise
+            floor = {'seconds': 0.01, 'alloc_peak_bytes': 1 << 20, 'rss_growth_kb': 1024}[measurement]
+            if result[measurement] > max(before[measurement], floor) * (1 + tolerance):
+                regressions.append(key(result) + (measurement, before[measurement], result[measurement]))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the graphComposer hot paths.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run the suite and write the results as JSON')
+    run_parser.add_argument('--out', default='bench_results.json')
+    run_parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 100000, 1000000])
+    run_parser.add_argument('--orders', type=int, nargs='*', default=[1])
+    run_parser.add_argument('--no-bundled', action='store_true', help='skip songs/ and texts/')
+    compare_parser = commands.add_parser('compare', help='list regressions between two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    commands.add_parser('sampling', help='graph sampling against random.choices')
+    commands.add_parser('orders', help='build time and memory of order 1 to 4 graphs')
+    commands.add_parser('ingest', help='ingestion speedup with more processes')
+    commands.add_parser('snapshot-update', help='check that save, load and update match a full build')
+    arguments = parser.parse_args()
+
+    if arguments.command == 'run':
+        report = run_suite(arguments.sizes, arguments.orders, not arguments.no_bundled)
+        with open(arguments.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'wrote {arguments.out}')
+    elif arguments.command == 'compare':
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        with open(arguments.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, arguments.tolerance)
+        for corpus, order, case, measurement, old, new in regressions:
+            print(f'{corpus} k={order} {case}: {measurement} {old:.4g} -> {new:.4g}')
+        print(f'{len(regressions)} regressions')
+        raise SystemExit(1 if regressions else 0)
+    elif arguments.command == 'orders':
+        bench_orders('texts/hp_sorcerer_stone.txt')
+    elif arguments.command == 'ingest':
+        bench_ingest()
+    elif arguments.command == 'snapshot-update':
+        raise SystemExit(0 if check_snapshot_update('texts/hp_sorcerer_stone.txt') else 1)
+    else:
+        bench_sampling('texts/hp_sorcerer_stone.txt')
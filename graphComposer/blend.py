@@ -0,0 +1,103 @@
+from array import array
+import numpy as np
+from batch import edge_arrays
+from graph import Graph
+
+def edge_list(g):
+    """
+    It lists the edges of a graph as three NumPy arrays, skipping the unused slots between rows
+
+    :param g: the graph
+    :return: A tuple of (sources, targets, counts) arrays.
+    """
+    starts, degrees, targets, counts = edge_arrays(g)
+    sources = np.repeat(np.arange(len(degrees)), degrees)
+    # the slot of the j-th edge of a row is the row's start plus j
+    row_first = np.repeat(np.cumsum(degrees) - degrees, degrees)
+    slots = np.repeat(starts, degrees) + np.arange(len(sources)) - row_first
+    return sources, targets[slots].astype(np.int64), counts[slots].astype(np.float64)
+
+def blend_graphs(weighted_graphs):
+    """
+    > Blend several graphs of the same order into one, for example [(avicii, 0.7), (queen, 0.3)] for
+    lyrics that are 70% avicii and 30% queen. Every graph's edge counts are scaled so that they add up
+    to its weight, then the edges of all the graphs are put on a shared vocabulary and the counts of
+    the same edge are summed. The next word after a state is then drawn from the mix of the graphs'
+    next words, weighted by the blend weights and by how common the state is in each graph. Apart from
+    mapping each graph's vocabulary once, the work is a few NumPy passes over all the edges
+
+    :param weighted_graphs: a list of (graph, weight) pairs
+    :return: A graph object with fractional ('f') edge counts that `compose` can use directly
+    """
+    orders = {g.order for g, _ in weighted_graphs}
+    if len(orders) != 1:
+        raise ValueError('Only graphs of the same order can be blended')
+    order = orders.pop()
+
+    words = []
+    word_ids = {}
+    sources, targets, counts, state_rows = [], [], [], []
+    state_offset = 0
+    for g, weight in weighted_graphs:
+        word_map = np.empty(len(g.words), dtype=np.int64)
+        for index, word in enumerate(g.words):
+            shared = word_ids.get(word)
+            if shared is None:
+                shared = word_ids[word] = len(words)
+                words.append(word)
+            word_map[index] = shared
+        if order == 1:
+            state_rows.append(word_map.reshape(-1, 1))
+        else:
+            state_words = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, order)
+            state_rows.append(word_map[state_words])
+
+        source, target, count = edge_list(g)
+        total = count.sum()
+        sources.append(source + state_offset)
+        targets.append(target + state_offset)
+        counts.append(count * (weight / total) if total else count)
+        state_offset += len(g)
+
+    return graph_from_edges(order, words, np.concatenate(state_rows), np.concatenate(sources),
+                            np.concatenate(targets), np.concatenate(counts), 'f')
+
+def graph_from_edges(order, words, state_rows, sources, targets, counts, count_type):
+    """
+    > Make a graph from a list of edges between states given by their word ids. States with the same
+    words are merged, and so are the edges between them, with their counts added up
+
+    :param order: the order of the graph
+    :param words: the list of words the word ids refer to
+    :param state_rows: an array with one row of `order` word ids per state
+    :param sources: the source state of every edge, as a row of state_rows
+    :param targets: the target state of every edge, as a row of state_rows
+    :param counts: the count of every edge
+    :param count_type: the array typecode of the counts of the graph
+    :return: A graph object
+    """
+    if order == 1:
+        state_map = state_rows[:, 0]
+        shared_states = np.arange(len(words)).reshape(-1, 1)
+    else:
+        shared_states, state_map = np.unique(state_rows, axis=0, return_inverse=True)
+        state_map = state_map.reshape(-1)
+    state_count = len(shared_states)
+
+    # sorting by source * state_count + target groups the edges by source, so the CSR arrays fall out
+    keys = state_map[sources] * state_count + state_map[targets]
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    weights = np.bincount(inverse.reshape(-1), weights=counts)
+    # within a row the edges go largest count first, like Graph keeps them
+    ordered = np.lexsort((unique_keys, -weights, unique_keys // state_count))
+    unique_keys, weights = unique_keys[ordered], weights[ordered]
+    degrees = np.bincount(unique_keys // state_count, minlength=state_count)
+    starts = np.cumsum(degrees) - degrees
+
+    return Graph._from_arrays(
+        order, words,
+        array('I', shared_states.astype(np.uint32).tobytes()) if order > 1 else array('I'),
+        array('Q', starts.astype(np.uint64).tobytes()),
+        array('I', degrees.astype(np.uint32).tobytes()),
+        array('I', (unique_keys % state_count).astype(np.uint32).tobytes()),
+        array(count_type, weights.astype(np.dtype(count_type)).tobytes()))
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+from graph import Graph, SNAPSHOT_VERSION
+
+# bump this when a change to the tokenizer or to make_graph changes the graph built from the same files
+CACHE_VERSION = 1
+
+# The GraphCache class keeps built graphs on disk as snapshots, keyed by the files they were built from.
+# A key covers the file names, sizes and content hashes, so a graph is only built again when one of its
+# files really changed. The content hashes are remembered in `hashes.json` by (size, mtime), so a file
+# is only read again when its size or mtime moved, and touching a file does not cost a rebuild.
+# Snapshots are evicted least recently used first once they take more than `max_bytes` together; a hit
+# bumps the snapshot's mtime, which is what the eviction goes by, so every process that uses the same
+# directory shares the order
+class GraphCache:
+    def __init__(self, directory='.graph_cache', max_bytes=256 << 20):
+        """
+        :param directory: the directory the snapshots are kept in, defaults to '.graph_cache' (optional)
+        :param max_bytes: the most bytes the snapshots may take together, defaults to 256 MiB (optional)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._hashes = None
+
+    def stats(self):
+        """
+        It reports how often a graph was found in the cache and how often it had to be built
+        :return: A dictionary with the hits, misses and hit rate.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def get_graph(self, paths, order, build):
+        """
+        > Return the graph of a list of files from the cache, or build it with `build(paths, order)`,
+        store it and return it
+
+        :param paths: the files the graph is made of, in order
+        :param order: the order of the graph
+        :param build: a function that builds the graph, like `compose.ingest`
+        :return: A graph object
+        """
+        snapshot = os.path.join(self.directory, self.key(paths, order) + '.graph')
+        if os.path.exists(snapshot):
+            try:
+                g = Graph.load(snapshot)
+            except (OSError, ValueError):
+                pass
+            else:
+                self.hits += 1
+                os.utime(snapshot)
+                return g
+
+        self.misses += 1
+        g = build(paths, order)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f'{snapshot}.{os.getpid()}.tmp'
+        g.save(temporary)
+        os.replace(temporary, snapshot)
+        self.evict(keep=snapshot)
+        return g
+
+    def key(self, paths, order):
+        """
+        It works out the cache key of a list of files
+
+        :param paths: the files the graph is made of, in order
+        :param order: the order of the graph
+        :return: A hex string.
+        """
+        digest = hashlib.sha256(f'{CACHE_VERSION} {SNAPSHOT_VERSION} {order}'.encode())
+        for path in paths:
+            stat = os.stat(path)
+            entry = [os.path.basename(path), stat.st_size, self.content_hash(path, stat)]
+            digest.update(json.dumps(entry).encode())
+        self._save_hashes()
+        return digest.hexdigest()
+
+    def content_hash(self, path, stat=None):
+        """
+        It returns the SHA-256 of a file, reading the file only if its size or mtime changed since the
+        last time
+
+        :param path: the file
+        :param stat: the result of os.stat for the file, if we already have it (optional)
+        :return: A hex string.
+        """
+        stat = stat or os.stat(path)
+        hashes = self._load_hashes()
+        name = os.path.abspath(path)
+        known = hashes.get(name)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        with open(path, 'rb') as f:
+            content = hashlib.file_digest(f, 'sha256').hexdigest()
+        hashes[name] = [stat.st_size, stat.st_mtime_ns, content]
+        self._hashes_changed = True
+        return content
+
+    def evict(self, keep=None):
+        """
+        It deletes the least recently used snapshots until the rest fit in `max_bytes`
+
+        :param keep: a snapshot that must not be deleted, like the one just written (optional)
+        """
+        snapshots = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.graph'):
+                stat = entry.stat()
+                snapshots.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in snapshots)
+        for _, size, path in sorted(snapshots):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _load_hashes(self):
+        if self._hashes is None:
+            self._hashes_changed = False
+            try:
+                with open(os.path.join(self.directory, 'hashes.json')) as f:
+                    self._hashes = json.load(f)
+            except (OSError, ValueError):
+                self._hashes = {}
+        return self._hashes
+
+    def _save_hashes(self):
+        if not self._hashes or not self._hashes_changed:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'hashes.json')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self._hashes, f)
+        os.replace(temporary, path)
+        self._hashes_changed = False
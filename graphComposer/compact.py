@@ -0,0 +1,226 @@
+import random
+from itertools import islice
+import numpy as np
+from blend import edge_list, graph_from_edges
+from compose import make_graph, stream
+from score import Scorer
+
+UNK = '<unk>'
+
+def state_rows(g):
+    """
+    It returns the word ids of every state of a graph, one row of `order` ids per state
+    :param g: the graph
+    :return: A NumPy array of shape (states, order)
+    """
+    if g.order == 1:
+        return np.arange(len(g.words)).reshape(-1, 1)
+    return np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, g.order).astype(np.int64)
+
+def word_counts(g):
+    """
+    It works out how often each word of a graph was seen, from the counts of the edges going into the
+    states that end with it
+
+    :param g: the graph
+    :return: An array with a count per word id
+    """
+    sources, targets, counts = edge_list(g)
+    return np.bincount(state_rows(g)[targets, -1], weights=counts, minlength=len(g.words))
+
+def quantize(sources, counts, count_type):
+    """
+    > Scale the counts of every row so that its largest count is the largest value of the count type,
+    and round, keeping every edge at 1 or more. Sampling only looks at the counts within a row, so this
+    keeps the next-word probabilities close while the counts take one or two bytes
+
+    :param sources: the source state of every edge, grouped by source
+    :param counts: the count of every edge
+    :param count_type: 'B' (uint8) or 'H' (uint16)
+    :return: The quantized counts, as floats
+    """
+    largest = float(np.iinfo(np.dtype(count_type)).max)
+    row_max = np.zeros(sources.max() + 1 if len(sources) else 0)
+    np.maximum.at(row_max, sources, counts)
+    scale = np.minimum(1.0, largest / row_max[sources])
+    return np.maximum(1.0, np.round(counts * scale))
+
+def compact_graph(g, min_edge_count=2, min_word_count=1, count_type=None, unk=UNK):
+    """
+    > Make a smaller copy of a graph. Words seen fewer than `min_word_count` times become `unk`, and the
+    edges seen fewer than `min_edge_count` times are dropped. Their count goes to the edges the row
+    keeps, in proportion to how often each target state is entered in the whole graph, which is the
+    lower-order (for order 1, unigram) back-off distribution over the row's own successors. So no rare
+    target is made more likely than the common ones, and every edge still goes to a real state. A row
+    whose edges are all rare keeps one edge, to its rare target that is entered most often. With a
+    count_type of 'B' or 'H' the counts are also quantized to one or two bytes
+
+    :param g: the graph
+    :param min_edge_count: the smallest count an edge keeps its own target with, defaults to 2 (optional)
+    :param min_word_count: the smallest count a word stays in the vocabulary with, defaults to 1 (optional)
+    :param count_type: 'B' or 'H' to quantize the counts, defaults to keeping the graph's type (optional)
+    :param unk: the word that stands for the pruned words, defaults to '<unk>' (optional)
+    :return: A graph object
+    """
+    order = g.order
+    frequent = word_counts(g) >= min_word_count
+    words = [word for word, keep in zip(g.words, frequent) if keep] + [unk]
+    unk_id = len(words) - 1
+    word_map = np.where(frequent, np.cumsum(frequent) - 1, unk_id)
+    sources, targets, counts = edge_list(g)
+
+    # the back-off weight of an edge is how often its target is entered, from any state
+    entered = np.bincount(targets, weights=counts, minlength=len(g._degrees))
+    rare = counts < min_edge_count
+    kept = ~rare
+    rare_mass = np.bincount(sources[rare], weights=counts[rare], minlength=len(g._degrees))
+    back_off = entered[targets[kept]]
+    back_off_total = np.bincount(sources[kept], weights=back_off, minlength=len(g._degrees))
+    # a kept edge's target is entered at least as often as the edge is taken, so no total is 0
+    kept_counts = counts[kept] + rare_mass[sources[kept]] * back_off / back_off_total[sources[kept]]
+
+    # a row with nothing but rare edges keeps the one to the target that is entered most often,
+    # leaving out the words that turn into unk unless all of them do
+    lone = rare & (back_off_total[sources] == 0)
+    lone_sources, lone_targets = sources[lone], targets[lone]
+    last_words = state_rows(g)[lone_targets, -1]
+    ranked = np.lexsort((-np.where(frequent[last_words], entered[lone_targets], -1), lone_sources))
+    lone_sources, lone_targets = lone_sources[ranked], lone_targets[ranked]
+    first = np.flatnonzero(np.diff(lone_sources, prepend=-1))
+    sources = np.concatenate((sources[kept], lone_sources[first]))
+    targets = np.concatenate((targets[kept], lone_targets[first]))
+    counts = np.concatenate((kept_counts, rare_mass[lone_sources[first]]))
+    merged = graph_from_edges(order, words, word_map[state_rows(g)], sources, targets, counts, 'd')
+    sources, targets, counts = edge_list(merged)
+    rows = state_rows(merged)
+
+    # the states that only the dropped edges went to cannot be reached any more, so their edges go too
+    while len(sources):
+        reached = np.zeros(len(rows), dtype=bool)
+        reached[targets] = True
+        kept = reached[sources]
+        if kept.all():
+            break
+        sources, targets, counts = sources[kept], targets[kept], counts[kept]
+    if order > 1:
+        used = np.unique(np.concatenate((sources, targets)))
+        rows = rows[used]
+        sources, targets = np.searchsorted(used, sources), np.searchsorted(used, targets)
+
+    count_type = count_type or g._count_type()
+    if count_type in ('B', 'H'):
+        counts = quantize(sources, counts, count_type)
+    elif count_type not in 'fd':
+        # the back-off shares are fractions, so whole-number counts are rounded, keeping every edge
+        counts = np.maximum(1.0, np.round(counts))
+    return graph_from_edges(order, words, rows, sources, targets, counts, count_type)
+
+def graph_bytes(g):
+    """
+    It adds up the memory the model data of a graph takes: its arrays, the block totals it has built
+    and its words
+    :param g: the graph
+    :return: A number of bytes
+    """
+    arrays = [g._state_words, g._starts, g._degrees, g._totals, g._targets, g._counts]
+    arrays += list(g._checkpoints.values())
+    return (sum(len(a) * a.itemsize for a in arrays) +
+            sum(len(word.encode('utf-8')) for word in g.words) + 8 * len(g.words))
+
+def row_divergence(full, small, unk=UNK):
+    """
+    > Measure how far the next-word distributions of a compact graph are from those of the graph it
+    was made from: the KL divergence of every row of `small` from the same row of `full`, averaged with
+    the weight of how often `full` leaves the state. The words of `full` that `small` does not have
+    count as `unk`, and a successor `full` never saw after a state gets the probability of one more
+    count spread like the words of the whole graph, so it is unlikely but not impossible. An edge that
+    makes something seen once after a state much more likely than it was shows up as a large
+    divergence
+
+    :param full: the graph before compaction
+    :param small: the graph after compaction
+    :param unk: the word that stands for the pruned words, defaults to '<unk>' (optional)
+    :return: The divergence in nats, 0 when the rows are the same
+    """
+    small_ids = {word: index for index, word in enumerate(small.words)}
+    word_map = np.array([small_ids.get(word, small_ids.get(unk, -1)) for word in full.words], dtype=np.int64)
+    full_sources, full_targets, full_counts = edge_list(full)
+    small_sources, small_targets, small_counts = edge_list(small)
+    full_rows, small_rows = word_map[state_rows(full)], state_rows(small)
+
+    # number the source states of both graphs by their words, then every edge by (source, next word)
+    states, source_ids = np.unique(np.concatenate((full_rows[full_sources], small_rows[small_sources])),
+                                   axis=0, return_inverse=True)
+    source_ids = source_ids.reshape(-1)
+    full_next, small_next = full_rows[full_targets, -1], small_rows[small_targets, -1]
+    base = len(small.words) + 1
+    full_keys = source_ids[:len(full_sources)] * base + full_next + 1
+    small_keys = source_ids[len(full_sources):] * base + small_next + 1
+    small_source_ids = source_ids[len(full_sources):]
+
+    keys, inverse = np.unique(full_keys, return_inverse=True)
+    pair_counts = np.bincount(inverse.reshape(-1), weights=full_counts)
+    found = np.minimum(np.searchsorted(keys, small_keys), len(keys) - 1)
+    seen = np.where(keys[found] == small_keys, pair_counts[found], 0)
+    row_totals = np.bincount(source_ids[:len(full_sources)], weights=full_counts, minlength=len(states))
+    unigram = np.bincount(full_next + 1, weights=full_counts, minlength=base) / full_counts.sum()
+
+    p = np.where(seen > 0, seen, unigram[small_next + 1]) / (row_totals[small_source_ids] + (seen == 0))
+    q = small_counts / np.bincount(small_sources, weights=small_counts)[small_sources]
+    weights = row_totals[small_source_ids] / full_counts.sum()
+    return float(np.sum(weights * q * np.log(q / p)))
+
+def unk_rate(g, length=10000, unk=UNK, seed=0):
+    """
+    It composes a long text from a graph and measures how much of it is the `unk` word
+    :param g: the graph
+    :param length: the number of words to compose, defaults to 10000 (optional)
+    :param unk: the word that stands for the pruned words, defaults to '<unk>' (optional)
+    :param seed: the seed of the composition, defaults to 0 (optional)
+    :return: The share of the composed words that are `unk`.
+    """
+    words = list(islice(stream(g, rng=random.Random(seed)), length))
+    return words.count(unk) / len(words)
+
+def compaction_report(words, holdout=0.1, order=1, **options):
+    """
+    > Build a graph from the first part of a text, compact it with `options` (see compact_graph) and
+    report how much memory that saves, how the perplexity on the held-out end of the text changes, how
+    far the rows moved from the full graph's (see row_divergence) and how much of a text composed from
+    the compact graph is the unk word. Dropping words from the vocabulary lowers the perplexity by
+    itself, since every unknown word then counts as the one unk word, so compare the perplexities of
+    runs with the same `min_word_count`
+
+    :param words: a list of words
+    :param holdout: the share of the words kept out of the graph, defaults to 0.1 (optional)
+    :param order: the order of the graph, defaults to 1 (optional)
+    :return: A dictionary with the sizes, perplexities and unk rates before and after, and the divergence
+    """
+    split = int(len(words) * (1 - holdout))
+    full = make_graph(words[:split], order)
+    small = compact_graph(full, **options)
+    before, after = graph_bytes(full), graph_bytes(small)
+    unk = options.get('unk', UNK)
+    return {'bytes_before': before, 'bytes_after': after, 'saved': 1 - after / before,
+            'edges_before': len(full._targets) - full._garbage, 'edges_after': len(small._targets),
+            'words_before': len(full.words), 'words_after': len(small.words),
+            'perplexity_before': Scorer(full).perplexity(words[split:]),
+            'perplexity_after': Scorer(small).perplexity(words[split:]),
+            'row_divergence': row_divergence(full, small, unk),
+            'unk_rate_before': unk_rate(full, unk=unk), 'unk_rate_after': unk_rate(small, unk=unk)}
+
+if __name__ == '__main__':
+    import argparse
+    from compose import get_words_from_text
+    parser = argparse.ArgumentParser(description='Report what pruning and quantizing a graph saves.')
+    parser.add_argument('path', help='a text file to build the graph from')
+    parser.add_argument('--order', type=int, default=1)
+    parser.add_argument('--min-edge-count', type=int, default=2)
+    parser.add_argument('--min-word-count', type=int, default=1)
+    parser.add_argument('--count-type', choices=['B', 'H'])
+    arguments = parser.parse_args()
+    report = compaction_report(get_words_from_text(arguments.path), order=arguments.order,
+                               min_edge_count=arguments.min_edge_count,
+                               min_word_count=arguments.min_word_count, count_type=arguments.count_type)
+    for name, value in report.items():
+        print(f'{name:>18}: {value:.3f}' if isinstance(value, float) else f'{name:>18}: {value}')
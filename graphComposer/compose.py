@@ -1,8 +1,76 @@
 import string
 import random
 import re
+import codecs
 import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+import numpy as np
 from graph import Graph, Vertex
+from batch import edge_arrays, start_weights
+from cache import GraphCache
+from dedupe import unique_paths
+
+# graphs built by main are kept here, so the songs are only read again when they change
+graph_cache = GraphCache('.graph_cache')
+
+# section tags like [Chorus] are dropped, from the first "[" on a line to the last "]" on it
+SECTION_TAG = re.compile(r'\[(.+)\]')
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+def tokenize_line(line):
+    """
+    It drops the section tags of one line of text, lowercases it, removes punctuation and returns its
+    words
+
+    :param line: a line of text without the newline
+    :return: A list of words
+    """
+    line = SECTION_TAG.sub(' ', line)
+    return line.lower().translate(PUNCTUATION).split()
+
+def iter_words_from_text(text_path, block_size=1 << 16):
+    """
+    > It reads a text file in blocks of `block_size` bytes and yields the same words as
+    `get_words_from_text`, one at a time, without ever holding the whole text in memory. Only the
+    unfinished line at the end of a block is carried over, and even that is trimmed: words before a
+    "[" are yielded as soon as they are complete, and the inside of a tag whose "]" has been seen is
+    thrown away, so only a line with an unclosed "[" has to be kept whole until its end
+    
+    :param text_path: the path to the text file
+    :param block_size: how many bytes to read at a time, defaults to 64 KiB (optional)
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    carry = ''
+    with open(text_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            text = carry + decoder.decode(block, final=not block)
+            lines = text.split('\n')
+            carry = lines.pop()
+            for line in lines:
+                yield from tokenize_line(line)
+            if not block:
+                break
+
+            tag = carry.find('[')
+            head = carry if tag == -1 else carry[:tag]
+            rest = '' if tag == -1 else carry[tag:]
+            tokens = head.split()
+            # the last word of the head may go on in the next block, or glue onto an unclosed tag
+            keep = tokens.pop() if tokens and not head[-1].isspace() else ''
+            for token in tokens:
+                word = token.lower().translate(PUNCTUATION)
+                if word:
+                    yield word
+            close = rest.rfind(']')
+            if close >= 2:
+                # whatever follows, everything from the "[" to this "]" is part of the tag
+                rest = '[ ' + rest[close:]
+            carry = keep + rest
+    yield from tokenize_line(carry)
 
 def get_words_from_text(text_path):
     """
@@ -11,82 +79,320 @@ def get_words_from_text(text_path):
     :param text_path: the path to the text file
     :return: A list of words
     """
-    with open(text_path, 'rb') as f:
-        text = f.read().decode("utf-8")
+    return list(iter_words_from_text(text_path))
 
-        text = re.sub(r'\[(.+)\]', ' ', text)
+def song_files(artist):
+    """
+    It lists the lyrics files of an artist in the `songs` directory, in the order the directory gives
+    them
 
-        text = ' '.join(text.split())
-        text = text.lower()
-        text = text.translate(str.maketrans('','', string.punctuation))
-    
-    words = text.split()
-    return words
+    :param artist: the artist whose songs we want
+    :return: A list of paths
+    """
+    return [f'songs/{artist}/{song_file}' for song_file in os.listdir(f'songs/{artist}')
+            if song_file != '.DS_Store']
 
-def make_graph(words):
+def gram_edge(gram, order):
     """
-    We're going to take a list of words, and create a graph where each word is a vertex, and each edge
-    is the probability of going from one word to another
-    
-    :param words: A list of words
-    :return: A graph object
+    It turns `order` + 1 consecutive words into the edge they stand for in a graph of that order
+
+    :param gram: a sequence of order + 1 words
+    :param order: the order of the graph
+    :return: A (source value, target value) pair
     """
-    g = Graph()
+    if order == 1:
+        return gram[0], gram[1]
+    gram = tuple(gram)
+    return gram[:-1], gram[1:]
 
-    previous_word = None
+def count_edges(paths, order=1):
+    """
+    > Tokenize a shard of files as if they were one text (the way `words.extend` joins them in
+    `main`) and count the edges of the graph they make. This is the work one process of `ingest` does
 
-    for word in words:
-        word_vertex = g.get_vertex(word)
+    :param paths: the files of the shard, in order
+    :param order: the order of the graph, defaults to 1 (optional)
+    :return: A tuple of (edge counts, first `order` words, last `order` words) of the shard
+    """
+    counts = {}
+    head = []
+    window = deque(maxlen=order + 1)
+    for path in paths:
+        for word in iter_words_from_text(path):
+            if len(head) < order:
+                head.append(word)
+            window.append(word)
+            if len(window) > order:
+                edge = gram_edge(window, order)
+                counts[edge] = counts.get(edge, 0) + 1
+    return counts, head, list(window)[-order:]
 
-        if previous_word:
-            previous_word.increment_edge(word_vertex)
+def split_shards(paths, shards):
+    """
+    It cuts a list of files into contiguous shards of about the same number of bytes
 
-        previous_word = word_vertex
+    :param paths: a list of paths
+    :param shards: how many shards to make
+    :return: A list of lists of paths
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    target = sum(sizes) / max(shards, 1)
+    result = [[]]
+    filled = 0
+    for path, size in zip(paths, sizes):
+        if filled >= target and len(result) < shards:
+            result.append([])
+            filled = 0
+        result[-1].append(path)
+        filled += size
+    return result
+
+def ingest(paths, order=1, workers=None):
+    """
+    > Build a graph from many files on a pool of processes. Each process counts the edges of a
+    contiguous shard of the files and the counts are merged into one graph. The edges that cross from
+    one shard to the next are added here from the first and last words of each shard, so the graph
+    is the same as `make_graph` over all the words of the files, one file after another
     
+    :param paths: the files to read, in order
+    :param order: the order of the graph, defaults to 1 (optional)
+    :param workers: the number of processes, defaults to the number of CPUs (optional)
+    :return: A graph object
+    """
+    workers = workers or os.cpu_count() or 1
+    # a few shards per process so that one long file does not hold up the others
+    shards = split_shards(paths, workers * 4 if workers > 1 else 1)
+    g = Graph(order)
+    window = []
+
+    def merge(results):
+        nonlocal window
+        for counts, head, tail in results:
+            g.increment_edges(counts)
+            joined = window + head
+            for start in range(min(len(window), len(joined) - order)):
+                source, target = gram_edge(joined[start:start + order + 1], order)
+                g.get_vertex(source).increment_edge(g.get_vertex(target))
+            window = (window + tail)[-order:]
+        g.tail = window
+
+    if workers == 1:
+        merge(map(count_edges, shards, repeat(order)))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            merge(pool.map(count_edges, shards, repeat(order)))
+
     g.generate_probability_mappings()
+    return g
 
+def add_song(g, song_path, index=None):
+    """
+    It adds the words of one more lyrics file (for example one `lyrics.save_lyrics` just wrote) to a
+    graph, without building the graph again
+
+    :param g: the graph
+    :param song_path: the path to the lyrics file
+    :param index: the ngrams.NgramIndex to add the file to as well (optional)
+    """
+    g.update(iter_words_from_text(song_path))
+    if index is not None:
+        index.update([song_path])
+
+def make_graph(words, order=1):
+    """
+    We're going to take a list of words, and create a graph where each word is a vertex, and each edge
+    is the probability of going from one word to another. With an order above 1 each vertex is the
+    tuple of the last `order` words instead of a single word
+    
+    :param words: A list of words
+    :param order: the number of previous words the next word depends on, defaults to 1 (optional)
+    :return: A graph object
+    """
+    g = Graph(order)
+    g.update(words)
     return g
 
-def compose(g, words, length=50):
+def compose(g, words=None, length=50, rng=None):
     """
     > Given a graph, a list of words, and a length, return a list of words of the given length, where
     each word is chosen randomly from the list of words, and the next word is chosen randomly from the
-    list of words that follow the current word in the graph
+    list of words that follow the current word in the graph. For an order k graph the composition
+    starts from k consecutive words of the list, and the order is taken from the graph
     
     :param g: the graph
-    :param words: a list of words to use as the starting point for the composition
+    :param words: a list of words to use as the starting point for the composition, or None to start
+    from a random vertex of the graph
     :param length: the length of the composition, defaults to 50 (optional)
+    :param rng: the generator to draw with, anything with a `random()` method like a random.Random or
+    a numpy.random.Generator, defaults to the random module (optional)
     :return: A list of words
     """
-    composition = []
-    word = g.get_vertex(random.choice(words))
-    for _ in range(length):
-        composition.append(word.value)
-        word = g.get_next_word(word)
+    rng = rng or random
+    composition, word = first_vertex(g, words, rng)
+    while len(composition) < length:
+        composition.append(word.word)
+        word = g.get_next_word(word, rng)
     
     return composition
 
-def main(artist):
+def first_vertex(g, words, rng):
+    """
+    It picks where a composition starts: a random vertex of the graph, or `order` consecutive words of
+    a list
+    :return: A tuple of (list of the words before the vertex's last one, vertex)
+    """
+    if words is None:
+        word = g.random_vertex(rng)
+        return ([] if g.order == 1 else list(word.value[:-1])), word
+    if g.order == 1:
+        return [], g.get_vertex(words[int(rng.random() * len(words))])
+    start = int(rng.random() * (len(words) - g.order + 1))
+    return words[start:start + g.order - 1], g.get_vertex(tuple(words[start:start + g.order]))
+
+def sink_backoffs(g):
+    """
+    > Find the sinks of a graph, the vertices no edge leaves (like the state of the last words of the
+    text), and where a composition that reaches one carries on from. In an order k graph that is the
+    state ending on the same word that has the most outgoing weight, so the next word still follows
+    the last one written; when there is none, and always in an order 1 graph, the composition starts
+    again from a random vertex
+
+    :param g: the graph
+    :return: A dictionary that maps the id of every sink to the id of its back-off vertex, or -1 for a
+    restart
+    """
+    starts, degrees, _, counts = edge_arrays(g)
+    sinks = np.flatnonzero(degrees == 0)
+    if g.order == 1:
+        return dict.fromkeys(sinks.tolist(), -1)
+    weights = start_weights(starts, degrees, counts)
+    last_words = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, g.order)[:, -1]
+    # states in increasing weight, so the heaviest state ending on a word is the last one written
+    by_weight = np.argsort(weights, kind='stable')
+    by_weight = by_weight[weights[by_weight] > 0]
+    best = np.full(len(g.words), -1, dtype=np.int64)
+    best[last_words[by_weight]] = by_weight
+    return dict(zip(sinks.tolist(), best[last_words[sinks]].tolist()))
+
+def stream(g, words=None, rng=None, backoffs=None):
+    """
+    > Yield the words of a composition one at a time, for as long as the caller asks for them (take
+    the first n with itertools.islice), keeping nothing but the current vertex. It starts like compose
+    does, and when it reaches a sink, where compose would fail, it backs off to the vertex
+    sink_backoffs gives, or restarts from a random vertex. The sinks are looked up in a table made
+    once, so every step costs one dictionary lookup more than in compose
+
+    :param g: the graph; it must not change while the stream is read
+    :param words: a list of words to start from, or None to start from a random vertex (optional)
+    :param rng: the generator to draw with, like in compose, defaults to the random module (optional)
+    :param backoffs: the sink_backoffs of the graph, if they were already worked out (optional)
+    :return: A generator of words
+    """
+    rng = rng or random
+    backoffs = sink_backoffs(g) if backoffs is None else backoffs
+    if len(backoffs) == len(g):
+        raise ValueError('The graph has no edges to compose from')
+    prefix, word = first_vertex(g, words, rng)
+    yield from prefix
+    while True:
+        yield word.word
+        backoff = backoffs.get(word.index)
+        if backoff is None:
+            word = g.get_next_word(word, rng)
+        elif backoff < 0:
+            word = g.random_vertex(rng)
+        else:
+            # the back-off state ends on the word just yielded, so the stream carries on after it
+            word = g.get_next_word(Vertex(g, backoff), rng)
+
+# the graph of the worker processes of compose_many, loaded once per process from a snapshot
+worker_graph = None
+
+def load_worker_graph(snapshot):
+    global worker_graph
+    worker_graph = Graph.load(snapshot)
+
+def compose_seeded(g, seeds, words, length):
+    """
+    It composes one composition per seed, each with its own numpy.random.Generator
+    :return: A list of lists of words
+    """
+    g = g or worker_graph
+    return [compose(g, words, length, np.random.default_rng(seed)) for seed in seeds]
+
+def compose_many(g, n, words=None, length=50, seed=None, workers=None, processes=False):
+    """
+    > Generate n compositions on a pool of workers, reproducibly. The seed is split with
+    `SeedSequence.spawn` into one independent stream per composition (not per worker), so the same
+    seed gives the same n compositions in the same order whatever the number of workers and whether
+    they are threads or processes. Processes open the graph from a snapshot with `Graph.load`, so they
+    share its pages instead of each getting a copy
+
+    :param g: the graph
+    :param n: the number of compositions
+    :param words: a list of words to pick the starting points from, or None to start from random
+    vertices of the graph (optional)
+    :param length: the length of each composition, defaults to 50 (optional)
+    :param seed: the seed, an int or a numpy.random.SeedSequence, defaults to fresh entropy (optional)
+    :param workers: the number of workers, defaults to the number of CPUs (optional)
+    :param processes: use processes instead of threads, defaults to False (optional)
+    :return: A list of n lists of words
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seeds = seed.spawn(n)
+    workers = workers or os.cpu_count() or 1
+    chunk = -(-n // (workers * 4)) or 1
+    chunks = [seeds[start:start + chunk] for start in range(0, n, chunk)]
+    # build everything before the pool starts, so no worker changes the arrays while another reads them
+    # (without drawing anything, so the global random module is left alone)
+    g.generate_probability_mappings(lazy=False)
+
+    if not processes:
+        with ThreadPoolExecutor(workers) as pool:
+            results = pool.map(compose_seeded, repeat(g), chunks, repeat(words), repeat(length))
+            return [composition for result in results for composition in result]
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, 'graph')
+        g.save(snapshot)
+        with ProcessPoolExecutor(workers, initializer=load_worker_graph, initargs=(snapshot,)) as pool:
+            results = pool.map(compose_seeded, repeat(None), chunks, repeat(words), repeat(length))
+            return [composition for result in results for composition in result]
+
+def main(artist, order=1, workers=None, cache=graph_cache, dedupe=True, index=True):
     """
     > We're going to take all the words from all the songs in the `songs` directory, make a graph out of
     them, and then use that graph to generate a new song
     
     :param artist: the artist you want to generate lyrics for
+    :param order: the number of previous words the next word depends on, defaults to 1 (optional)
+    :param workers: the number of processes that read the songs, defaults to the number of CPUs
+    (optional)
+    :param cache: the GraphCache to keep the graph in, or None to always build it (optional)
+    :param dedupe: leave out the songs that repeat (or nearly repeat) an earlier one, defaults to True
+    (optional)
+    :param index: bring the n-gram index of the songs in '.graph_cache' up to date too, see
+    ngrams.NgramIndex, defaults to True (optional)
     :return: A string of words
     """
     # words from text
     # words = get_words_from_text('texts/hp_sorcerer_stone.txt')
+    # g = make_graph(words, order)
 
     # for song lyrics
-    words = []
-    for song_file in os.listdir(f'songs/{artist}'):
-        if song_file == '.DS_Store':
-            continue
-        song_words = get_words_from_text(f'songs/{artist}/{song_file}')
-        words.extend(song_words)
-
-    g = make_graph(words)
-    composition = compose(g, words, 100)
+    build = lambda paths, order: ingest(paths, order, workers)
+    paths = song_files(artist)
+    if dedupe:
+        paths = unique_paths(paths)
+    if cache is None:
+        g = build(paths, order)
+    else:
+        g = cache.get_graph(paths, order, build)
+    if index:
+        from ngrams import NgramIndex
+        ngram_index = NgramIndex()
+        ngram_index.update(paths)
+        ngram_index.close()
+    composition = compose(g, None, 100)
     return ' '.join(composition)
 
 # This is a common pattern in Python. It allows you to run the main function of your program by
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import zlib
+import numpy as np
+# MinHash uses universal hashing (a * x + b) mod p with a Mersenne prime small enough that a * x fits in
+# 64 bits for 32-bit shingle hashes; the coefficients are fixed so signatures stay valid between runs
+PRIME = (1 << 31) - 1
+COEFFICIENTS = np.random.default_rng(20240601).integers(1, PRIME, size=(2, 128), dtype=np.uint64)
+
+def shingles(text, size=3):
+    """
+    It hashes every run of `size` consecutive words of a text to a 32-bit number. The words are the ones
+    the graph is built from (see compose.tokenize_line)
+
+    :param text: the text
+    :param size: the number of words per shingle, defaults to 3 (optional)
+    :return: An array with the distinct shingle hashes, empty for a text of fewer than `size` words
+    """
+    # compose imports this module, so the tokenizer is imported when it is needed
+    from compose import tokenize_line
+    words = [word for line in text.split('\n') for word in tokenize_line(line)]
+    grams = [' '.join(words[start:start + size]) for start in range(len(words) - size + 1)]
+    return np.unique(np.array([zlib.crc32(gram.encode()) for gram in grams], dtype=np.uint64))
+
+def minhash(hashes, num_hashes=128):
+    """
+    It makes the MinHash signature of a set of shingle hashes. Two signatures agree in about the same
+    share of places as the Jaccard similarity of the two sets
+
+    :param hashes: an array of shingle hashes
+    :param num_hashes: the length of the signature, at most 128, defaults to 128 (optional)
+    :return: A list of num_hashes ints
+    """
+    a, b = COEFFICIENTS[:, :num_hashes]
+    return ((np.outer(hashes % PRIME, a) + b) % PRIME).min(axis=0).tolist()
+
+# The Fingerprints class keeps the SHA-256 and the MinHash signature of every file it has seen in a
+# JSON file, by (size, mtime) like GraphCache does with its hashes, so a file is only read again when it
+# changed
+class Fingerprints:
+    def __init__(self, path=os.path.join('.graph_cache', 'fingerprints.json'), num_hashes=128):
+        """
+        :param path: the JSON file, defaults to '.graph_cache/fingerprints.json' (optional)
+        :param num_hashes: the length of the MinHash signatures, defaults to 128 (optional)
+        """
+        self.path = path
+        self.num_hashes = num_hashes
+        self._entries = None
+        self._changed = False
+
+    def get(self, path):
+        """
+        It returns the fingerprint of a file, working it out only if the file changed since last time
+        :param path: the file
+        :return: A tuple of (SHA-256 hex string, MinHash signature), with None for the signature of a
+        file too short for a single shingle
+        """
+        entries = self._load()
+        stat = os.stat(path)
+        name = os.path.abspath(path)
+        known = entries.get(name)
+        if (known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns and
+                (known[3] is None or len(known[3]) == self.num_hashes)):
+            return known[2], known[3]
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        hashes = shingles(content.decode('utf-8', 'replace'))
+        signature = minhash(hashes, self.num_hashes) if len(hashes) else None
+        entries[name] = [stat.st_size, stat.st_mtime_ns, digest, signature]
+        self._changed = True
+        return digest, signature
+
+    def save(self):
+        """
+        It writes the fingerprints back to the JSON file if any changed
+        """
+        if not self._changed:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(temporary, self.path)
+        self._changed = False
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+def find_duplicates(paths, fingerprints=None, threshold=0.7, bands=32):
+    """
+    > Find the files that repeat an earlier file of the list: exact copies by their SHA-256, and near
+    copies (another crawl of the same lyrics) by their MinHash signatures. The signatures are cut into
+    `bands` bands, and only files that agree on a whole band are compared, so the work stays close to
+    linear in the number of files. A pair counts as a near copy when its signatures agree in at least
+    `threshold` of their places. A file too short for a single shingle is only matched exactly, since
+    the signatures of such files would all look alike
+
+    :param paths: the files, in order; the first of a group of copies is the one kept
+    :param fingerprints: the Fingerprints to use, defaults to one in '.graph_cache' (optional)
+    :param threshold: the estimated Jaccard similarity of a near copy, defaults to 0.7 (optional)
+    :param bands: the number of LSH bands, must divide the signature length, defaults to 32 (optional)
+    :return: A dictionary that maps every duplicate to the earlier file it repeats
+    """
+    fingerprints = fingerprints or Fingerprints()
+    found = [fingerprints.get(path) for path in paths]
+    fingerprints.save()
+
+    duplicates = {}
+    by_digest = {}
+    buckets = {}
+    kept = []
+    for path, (digest, signature) in zip(paths, found):
+        original = by_digest.setdefault(digest, path)
+        if original != path:
+            duplicates[path] = original
+            continue
+        if signature is None:
+            continue
+        signature = np.array(signature)
+        rows = len(signature) // bands
+        keys = [(band, tuple(signature[band * rows:(band + 1) * rows].tolist())) for band in range(bands)]
+        candidates = {index for key in keys for index in buckets.get(key, ())}
+        similarity = {index: (kept[index][1] == signature).mean() for index in candidates}
+        best = max(similarity, key=similarity.get, default=None)
+        if best is not None and similarity[best] >= threshold:
+            duplicates[path] = kept[best][0]
+            continue
+        for key in keys:
+            buckets.setdefault(key, []).append(len(kept))
+        kept.append((path, signature))
+    return duplicates
+
+def unique_paths(paths, fingerprints=None, threshold=0.7):
+    """
+    It drops the files that repeat an earlier file of the list, see find_duplicates
+    :param paths: the files, in order
+    :param fingerprints: the Fingerprints to use, defaults to one in '.graph_cache' (optional)
+    :param threshold: the estimated Jaccard similarity of a near copy, defaults to 0.7 (optional)
+    :return: The list of paths without the duplicates
+    """
+    duplicates = find_duplicates(paths, fingerprints, threshold)
+    return [path for path in paths if path not in duplicates]
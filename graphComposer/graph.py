@@ -1,105 +1,847 @@
 import random
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from mmap import ACCESS_COPY, mmap as memory_map
 
-# The Vertex class is a node in the graph. It has a value, a dictionary of adjacent vertices, and a
-# list of neighbors and their weights
+# a graph snapshot starts with this header; the arrays follow it, each one starting on an 8 byte boundary
+SNAPSHOT_MAGIC = b'GCGRAPH\0'
+SNAPSHOT_VERSION = 6
+SNAPSHOT_HEADER = struct.Struct('<8sIIIIQQQQQQ')
+# a draw walks at most this many slots of a row; longer rows are cut into blocks of this many slots
+SCAN_BLOCK = 32
+
+# The Vertex class is a lightweight handle on one state of a Graph. The graph gives every state an
+# integer id and keeps all the edges in flat arrays, so a vertex is just the graph plus that id. In a
+# first order graph a state is a single word, in an order k graph it is the tuple of the last k words
 class Vertex:
-    def __init__(self, value):
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index):
+        """
+        The function takes in a graph and the id of a state in it and creates a handle on that state
+
+        :param graph: The graph the vertex belongs to
+        :param index: The integer id of the state in the graph
+        """
+        self.graph = graph
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, Vertex) and self.graph is other.graph and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.graph), self.index))
+
+    def __repr__(self):
+        return f'Vertex({self.value!r})'
+
+    @property
+    def value(self):
+        """
+        It returns the word this vertex stands for, or the tuple of words in an order k graph
+        :return: The value of the vertex.
+        """
+        return self.graph._state_value(self.index)
+
+    @property
+    def word(self):
+        """
+        It returns the last word of the state, which is the word a composition emits when it reaches
+        this vertex
+        :return: The word of the vertex.
+        """
+        return self.graph._state_word(self.index)
+
+    @property
+    def adjacent(self):
+        """
+        It builds a dictionary that maps each adjacent vertex to the weight of the edge going to it
+        :return: A dictionary of adjacent vertices and their weights.
+        """
+        return {Vertex(self.graph, target): count for target, count in self.graph._row(self.index)}
+
+    @property
+    def neighbors(self):
+        """
+        It returns the list of vertices that follow this vertex
+        :return: A list of vertices.
         """
-        The function takes in a value and creates a node with that value
-        
-        :param value: The value of the node
+        return [Vertex(self.graph, target) for target, _ in self.graph._row(self.index)]
+
+    @property
+    def neighbors_weights(self):
+        """
+        It returns the weights of the edges to the vertices in `neighbors`, in the same order
+        :return: A list of weights.
         """
-        self.value = value
-        self.adjacent = {}
-        self.neighbors = []
-        self.neighbors_weights = []
+        return [count for _, count in self.graph._row(self.index)]
 
     def add_edge_to(self, vertex, weight=0):
         """
-        This function adds a vertex to the adjacency list of the current vertex
-        
+        This function sets the weight of the edge from the current vertex to another vertex
+
         :param vertex: The vertex to add an edge to
         :param weight: The weight of the edge between the two vertices, defaults to 0 (optional)
         """
-        self.adjacent[vertex] = weight
-    
+        self.graph._set_edge(self.index, vertex.index, weight)
+
     def increment_edge(self, vertex):
         """
-        If the vertex is already in the dictionary, increment the value by 1. Otherwise, add the vertex
-        to the dictionary with a value of 1
-        
+        It adds 1 to the count of the edge from the current vertex to the given vertex
+
         :param vertex: The vertex to increment the edge count for
         """
-        self.adjacent[vertex] = self.adjacent.get(vertex, 0) + 1
-    
+        key = self.index << 32 | vertex.index
+        pending = self.graph._pending
+        pending[key] = pending.get(key, 0) + 1
+
     def get_probability_map(self):
         """
-        It takes the adjacent vertices and weights of a vertex and adds them to the vertex's neighbors
-        and neighbors_weights lists.
+        It makes sure every edge count recorded for this vertex is in the graph's edge arrays, so the
+        vertex is ready to be sampled from.
         """
-        for (vertex, weight) in self.adjacent.items():
-            self.neighbors.append(vertex)
-            self.neighbors_weights.append(weight)
-        
-    def next_word(self):
+        self.graph._freeze()
+
+    def next_word(self, rng=None):
         """
-        > Given a list of neighbors and a list of weights, return a random neighbor based on the weights
-        :return: A random word from the list of neighbors.
+        > Draw a random neighbor based on the weights. The row is sorted by count, so walking it from
+        the most likely edge usually stops after a slot or two. A row longer than SCAN_BLOCK first
+        finds the block the draw falls in by bisecting the running totals of its blocks, so a draw
+        walks at most SCAN_BLOCK slots however many neighbors the vertex has
+
+        :param rng: the generator to draw with, anything with a `random()` method like a random.Random
+        or a numpy.random.Generator, defaults to the random module (optional)
+        :return: A random vertex from the list of neighbors.
         """
-        return random.choices(self.neighbors, weights=self.neighbors_weights)[0]
+        graph = self.graph
+        if graph._pending:
+            graph._freeze()
+        index = self.index
+        degree = graph._degrees[index]
+        if not degree:
+            raise IndexError('Cannot choose from an empty sequence')
+        slot = graph._starts[index]
+        point = (rng or random).random() * graph._totals[index]
+        if degree > SCAN_BLOCK:
+            checkpoints = graph._checkpoints.get(index) or graph._ready_checkpoints(index)
+            block = bisect_right(checkpoints, point)
+            if block:
+                point -= checkpoints[block - 1]
+            slot += block * SCAN_BLOCK
+            degree = min(degree - block * SCAN_BLOCK, SCAN_BLOCK)
+        counts = graph._counts
+        last = slot + degree - 1
+        while slot < last and point >= counts[slot]:
+            point -= counts[slot]
+            slot += 1
+        return Vertex(graph, graph._targets[slot])
 
-# The Graph class is a container for all the vertices in the graph. It has methods for adding
-# vertices, getting vertices, and getting the next word in the graph
+# The Graph class gives every word an integer id and stores the edges CSR-style: the edges leaving a
+# vertex sit next to each other in the `_targets` and `_counts` arrays, starting at `_starts[id]` and
+# running for `_degrees[id]` slots. Increments are collected in `_pending` and folded into the arrays
+# by generate_probability_mappings. A vertex is sampled by walking its row; a row longer than
+# SCAN_BLOCK also gets the running totals of its blocks of slots in `_checkpoints`, built the first
+# time the vertex is sampled and again after its row changed, so a graph is ready to use as soon as
+# its counts are in and sampling adds one number per SCAN_BLOCK slots of the rows it touches.
+# `_totals` keeps the total count of every row, and random_vertex draws from a Fenwick tree over the
+# totals of blocks of SCAN_BLOCK rows that is updated along with them, so neither has to be worked out
+# again after a change.
+# Every row is kept sorted by count, largest first, so the most likely successors of a vertex are the
+# first slots of its row. With order k > 1 the vertices are
+# states of k words: each state is interned under a key that packs the k word ids into one integer,
+# and `_state_words` holds the k word ids of every state back to back
 class Graph:
-    def __init__(self):
+    def __init__(self, order=1, count_type='I'):
         """
         The function __init__() is a special function in Python classes. It is run as soon as an object
         of a class is instantiated. The method is useful to do any initialization you want to do with
         your object
+
+        :param order: the number of previous words a state remembers, defaults to 1 (optional)
+        :param count_type: the array typecode of the edge counts, 'I' (uint32) by default; 'f' holds the
+        fractional weights of a blended graph (optional)
         """
-        self.vertices = {}
+        if order < 1:
+            raise ValueError('The order of a graph must be at least 1')
+        self.order = order
+        self.words = []
+        self.word_ids = {}
+        # packed word ids -> state id, only used when order > 1
+        self._state_ids = {}
+        self._state_words = array('I')
+        self._starts = array('Q')
+        self._degrees = array('I')
+        self._targets = array('I')
+        self._counts = array(count_type)
+        # vertex id -> running totals of the blocks of its row, for the rows longer than SCAN_BLOCK
+        self._checkpoints = {}
+        # (source id << 32 | target id) -> count that is not in the edge arrays yet
+        self._pending = {}
+        # number of slots in the edge arrays that no row uses any more
+        self._garbage = 0
+        # the total outgoing count of every state
+        self._totals = array(_total_type(count_type))
+        # a Fenwick tree over `_totals` for random_vertex, built the first time it is needed
+        self._tree = None
+        # the last `order` words given to update, which the next words given to it continue from
+        self.tail = []
+
+    def __len__(self):
+        if self.order == 1:
+            return len(self.words)
+        return len(self._state_ids)
 
     def get_vertex_values(self):
         """
         It returns a set of all the vertex values in the graph
-        :return: The keys of the vertices dictionary.
+        :return: The words in the graph, or the tuples of words in an order k graph.
         """
-        return set(self.vertices.keys())
-    
+        if self.order == 1:
+            return set(self.word_ids)
+        return {self._state_value(index) for index in range(len(self))}
+
     def add_vertex(self, value):
         """
-        We create a new key in the vertices dictionary with the value of the vertex as the key and the
-        vertex object as the value
-        
+        We give the value the next free integer id and remember the word (or words) for that id
+
         :param value: The value of the vertex to be added
         """
-        self.vertices[value] = Vertex(value)
-    
+        self._add_state(value)
+
     def get_vertex(self, value):
         """
         If the value is not in the graph, add it. Then return the vertex
-        
-        :param value: The value of the vertex to get
+
+        :param value: The value of the vertex to get, a tuple of `order` words when order > 1
         :return: The vertex with the value that is passed in.
         """
-        if value not in self.vertices:
-            self.add_vertex(value)
-        return self.vertices[value]
-    
-    def get_next_word(self, current_vertex):
+        index = self._find_state(value)
+        if index is None:
+            index = self._add_state(value)
+        return Vertex(self, index)
+
+    def get_next_word(self, current_vertex, rng=None):
         """
         Given a vertex, return the next word in the graph
-        
+
         :param current_vertex: The current vertex we're at in the graph
+        :param rng: the generator to draw with, see Vertex.next_word (optional)
         :return: The next word in the graph.
         """
-        return self.vertices[current_vertex.value].next_word()
-    
-    def generate_probability_mappings(self):
+        return current_vertex.next_word(rng)
+
+    def update(self, words):
+        """
+        > Add a stream of words to the graph, as if it was written right after the words the graph has
+        seen so far (`tail`). Only the vertices the new words touch get their edge rows and block
+        totals rebuilt, so adding a song costs time for that song and the rows it touches, not for the
+        whole graph
+
+        :param words: A list or iterator of words
+        """
+        window = deque(self.tail, maxlen=self.order)
+        previous = None
+        if len(window) == self.order:
+            previous = self.get_vertex(window[0] if self.order == 1 else tuple(window))
+        for word in words:
+            window.append(word)
+            if len(window) < self.order:
+                continue
+            vertex = self.get_vertex(word if self.order == 1 else tuple(window))
+            if previous is not None:
+                previous.increment_edge(vertex)
+            previous = vertex
+        self.tail = list(window)
+        self._freeze()
+
+    def increment_edges(self, counts):
+        """
+        It adds a whole table of edge counts to the graph at once, for example one that was counted
+        in another process
+
+        :param counts: A dictionary that maps (source value, target value) pairs to counts
+        """
+        pending = self._pending
+        for (source, target), count in counts.items():
+            key = self.get_vertex(source).index << 32 | self.get_vertex(target).index
+            pending[key] = pending.get(key, 0) + count
+
+    def random_vertex(self, rng=None):
+        """
+        It picks a random vertex, each one as likely as the share of the edge counts that leave it,
+        which is how often its word (or words) appeared in the text minus the final occurrence
+
+        :param rng: the generator to draw with, like in Vertex.next_word, defaults to the random module
+        (optional)
+        :return: A random vertex.
+        """
+        tree = self._weight_tree()
+        size = len(tree) - 1
+        # walk down the tree to the first block of states whose running total is above the drawn
+        # number, then along the block to the state
+        remaining = (rng or random).random() * self._prefix_total(size)
+        position = 0
+        step = 1 << size.bit_length() >> 1
+        while step:
+            if position + step <= size and tree[position + step] <= remaining:
+                position += step
+                remaining -= tree[position]
+            step >>= 1
+        totals = self._totals
+        index = min(position, size - 1) * SCAN_BLOCK
+        last = min(index + SCAN_BLOCK, len(totals)) - 1
+        while index < last and remaining >= totals[index]:
+            remaining -= totals[index]
+            index += 1
+        return Vertex(self, index)
+
+    def top_k(self, value, k):
+        """
+        It returns the k most likely words to come after a vertex. The rows are kept sorted by count,
+        so this reads the first k slots of the row and costs O(k)
+
+        :param value: a word, or a tuple of `order` words when order > 1
+        :param k: the number of words
+        :return: A list of up to k (word, probability) pairs, most likely first, empty if the graph does
+        not know the value.
+        """
+        index = self._find_state(value)
+        if self._pending:
+            self._freeze()
+        if index is None or index >= len(self._degrees):
+            return []
+        total = self._totals[index]
+        start = self._starts[index]
+        end = start + min(k, self._degrees[index])
+        return [(self._state_word(target), count / total)
+                for target, count in zip(self._targets[start:end], self._counts[start:end])]
+
+    def save(self, path):
+        """
+        > Write the graph to a snapshot file: a versioned header, then the vocabulary (word offsets, one
+        block of UTF-8 and the word ids in sorted order), the states of an order k graph, the row
+        totals, the edge arrays and the `tail` that the next update continues from. The block totals
+        are left out and built again as the loaded graph is sampled. `Graph.load` can open it without
+        reading it all in
+
+        :param path: the file to write
+        """
+        self._freeze()
+        self._add_rows()
+        if self._garbage:
+            self._compact()
+
+        blob = bytearray()
+        word_offsets = array('Q', [0])
+        for word in self.words:
+            blob += word.encode('utf-8')
+            word_offsets.append(len(blob))
+        word_order = array('I', sorted(range(len(self.words)), key=self.words.__getitem__))
+        if self.order == 1:
+            state_order = array('I')
+        else:
+            state_order = array('I', sorted(range(len(self)), key=self._state_key_of))
+        # the words of the tail are kept like the vocabulary, since they need not be in it yet
+        tail_blob = bytearray()
+        tail_offsets = array('Q', [0])
+        for word in self.tail:
+            tail_blob += word.encode('utf-8')
+            tail_offsets.append(len(tail_blob))
+
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.order,
+                                      sys.byteorder == 'little', ord(self._count_type()),
+                                      len(self.words), len(self),
+                                      len(self._targets), len(blob), len(self.tail), len(tail_blob))
+        sections = [word_offsets, blob, word_order, self._state_words, state_order, self._starts,
+                    self._degrees, self._totals, self._targets, self._counts, tail_offsets, tail_blob]
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(bytes(-len(header) % 8))
+            for section in sections:
+                data = memoryview(section).cast('B')
+                f.write(data)
+                f.write(bytes(-len(data) % 8))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        > Open a graph written by `save`. With mmap the file is mapped copy-on-write and the graph works
+        straight on the mapped pages, so loading costs the same however big the graph is and processes
+        that load the same file share its memory. Words are decoded and looked up (by binary search over
+        the sorted word ids) only when they are needed. The first change to the graph copies everything
+        into ordinary arrays
+
+        :param path: the file to read
+        :param mmap: map the file instead of reading it, defaults to True (optional)
+        :return: A graph object
+        """
+        with open(path, 'rb') as f:
+            if mmap:
+                buffer = memoryview(memory_map(f.fileno(), 0, access=ACCESS_COPY))
+            else:
+                buffer = memoryview(bytearray(f.read()))
+
+        (magic, version, order, little_endian, count_type, word_count, state_count, slot_count,
+         blob_size, tail_count, tail_size) = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a graph snapshot')
+        count_type = chr(count_type)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is a version {version} graph snapshot, expected version {SNAPSHOT_VERSION}')
+        if little_endian != (sys.byteorder == 'little'):
+            raise ValueError(f'{path} was written on a machine with a different byte order')
+
+        position = SNAPSHOT_HEADER.size + -SNAPSHOT_HEADER.size % 8
+
+        def section(typecode, count):
+            nonlocal position
+            size = count * array(typecode).itemsize
+            view = buffer[position:position + size].cast(typecode)
+            position += size + -size % 8
+            return view
+
+        g = cls(order, count_type)
+        word_offsets = section('Q', word_count + 1)
+        blob = section('B', blob_size)
+        word_order = section('I', word_count)
+        g._state_words = section('I', state_count * order if order > 1 else 0)
+        state_order = section('I', state_count if order > 1 else 0)
+        g._starts = section('Q', state_count)
+        g._degrees = section('I', state_count)
+        g._totals = section(_total_type(count_type), state_count)
+        g._targets = section('I', slot_count)
+        g._counts = section(count_type, slot_count)
+        g.tail = list(_MappedWords(section('Q', tail_count + 1), section('B', tail_size)))
+
+        g.words = _MappedWords(word_offsets, blob)
+        g.word_ids = _MappedIndex(word_order, g.words.__getitem__)
+        if order > 1:
+            g._state_ids = _MappedIndex(state_order, g._state_key_of)
+        if not mmap:
+            g._thaw()
+        return g
+
+    def generate_probability_mappings(self, lazy=True):
         """
-        For each vertex in the graph, generate a probability map that maps each vertex to a probability
-        of being the next vertex in the graph.
+        Fold every pending edge count into the edge arrays. The block totals that let a vertex with a
+        long row be sampled quickly, and the Fenwick tree random_vertex draws from, are built when they
+        are first used, or all of them now when lazy is False (so that many threads can sample without
+        building them as they go). Nothing is drawn either way
+
+        :param lazy: leave the block totals and the tree to be built on first use, defaults to True (optional)
+        """
+        self._freeze()
+        if not lazy:
+            self._add_rows()
+            self._weight_tree()
+            for index, degree in enumerate(self._degrees):
+                if degree > SCAN_BLOCK and index not in self._checkpoints:
+                    self._ready_checkpoints(index)
+
+    def _find_state(self, value):
+        """
+        It looks up the id of a state without adding it to the graph
+
+        :param value: a word, or a tuple of `order` words when order > 1
+        :return: The id of the state, or None if the graph does not know the value.
+        """
+        if self.order == 1:
+            return self.word_ids.get(value)
+        key = self._state_key(value)
+        return None if key is None else self._state_ids.get(key)
+
+    def _word_id(self, word):
+        """
+        It returns the id of a word, giving the word a new id if it has none yet
+
+        :param word: The word to look up
+        :return: The id of the word.
         """
-        for vertex in self.vertices.values():
-            vertex.get_probability_map()
+        index = self.word_ids.get(word)
+        if index is None:
+            index = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        return index
+
+    def _state_key(self, value):
+        """
+        It packs the word ids of a state into one integer, so states can be looked up without keeping
+        a tuple of strings per state
+
+        :param value: A tuple of `order` words
+        :return: The packed key, or None if one of the words is not in the graph.
+        """
+        if len(value) != self.order:
+            raise ValueError(f'A state of this graph is a tuple of {self.order} words')
+        key = 0
+        for word in value:
+            index = self.word_ids.get(word)
+            if index is None:
+                return None
+            key = key << 32 | index
+        return key
+
+    def _add_state(self, value):
+        """
+        It gives a new state the next free id
+
+        :param value: A word, or a tuple of `order` words when order > 1
+        :return: The id of the state.
+        """
+        self._thaw()
+        if self.order == 1:
+            return self._word_id(value)
+        if len(value) != self.order:
+            raise ValueError(f'A state of this graph is a tuple of {self.order} words')
+        key = 0
+        ids = []
+        for word in value:
+            ids.append(self._word_id(word))
+            key = key << 32 | ids[-1]
+        index = self._state_ids.setdefault(key, len(self._state_ids))
+        if index == len(self._state_words) // self.order:
+            self._state_words.extend(ids)
+        return index
+
+    def _weight_tree(self):
+        """
+        It returns the Fenwick tree over the totals of the blocks of SCAN_BLOCK states, building it the
+        first time: entry i (counting from 1) holds the total of the blocks i - (i & -i) up to i - 1
+        :return: An array with one more entry than there are blocks.
+        """
+        if self._pending:
+            self._freeze()
+        if self._tree is None:
+            totals = self._totals
+            tree = array(_total_type(self._count_type()), bytes(totals.itemsize))
+            tree.extend(sum(totals[start:start + SCAN_BLOCK]) for start in range(0, len(totals), SCAN_BLOCK))
+            for position in range(1, len(tree)):
+                parent = position + (position & -position)
+                if parent < len(tree):
+                    tree[parent] += tree[position]
+            self._tree = tree
+        return self._tree
+
+    def _prefix_total(self, count):
+        """
+        It adds up the totals of the first `count` blocks of states with the Fenwick tree
+        :param count: the number of blocks
+        :return: The total.
+        """
+        tree = self._tree
+        total = 0
+        while count:
+            total += tree[count]
+            count &= count - 1
+        return total
+
+    def _count_type(self):
+        """
+        It returns the typecode of the edge counts, whether they are in an array or in a loaded file
+        :return: A typecode like 'I'.
+        """
+        return getattr(self._counts, 'typecode', None) or self._counts.format
+
+    @classmethod
+    def _from_arrays(cls, order, words, state_words, starts, degrees, targets, counts):
+        """
+        > Make a graph straight from its vocabulary and CSR arrays, for code that works out a whole new
+        set of edges at once (like blending graphs) instead of counting them one by one
+
+        :param order: the order of the graph
+        :param words: the list of words, in id order
+        :param state_words: an array('I') with the word ids of every state (empty when order is 1)
+        :param starts: an array('Q') with the first edge slot of every vertex
+        :param degrees: an array('I') with the number of edges of every vertex
+        :param targets: an array('I') with the target of every edge slot
+        :param counts: an array with the count of every edge slot, of the graph's count type. The slots
+        of every row must be sorted by count, largest first
+        :return: A graph object
+        """
+        g = cls(order, counts.typecode)
+        g.words = list(words)
+        g.word_ids = {word: index for index, word in enumerate(g.words)}
+        if order > 1:
+            g._state_words = state_words
+            g._state_ids = {g._state_key_of(index): index for index in range(len(state_words) // order)}
+        g._starts = starts
+        g._degrees = degrees
+        g._targets = targets
+        g._counts = counts
+        g._totals.extend(sum(counts[start:start + degree]) for start, degree in zip(starts, degrees))
+        return g
+
+    def _state_key_of(self, index):
+        """
+        It packs the word ids of a state the same way `_state_key` does
+
+        :param index: The id of the state
+        :return: The packed key.
+        """
+        key = 0
+        start = index * self.order
+        for word_index in self._state_words[start:start + self.order]:
+            key = key << 32 | word_index
+        return key
+
+    def _add_rows(self):
+        """
+        It makes room in the per-vertex arrays for the vertices that were added since the last time
+        """
+        if len(self) > len(self._totals):
+            # each array is grown to the right length on its own, so a call that failed half way
+            # can be made again
+            for values in (self._starts, self._degrees, self._totals):
+                _grow(values, len(self))
+            tree = self._tree
+            if tree is not None:
+                # a new state has no edges yet, so the entry of a new block is the total of the
+                # blocks it covers
+                for position in range(len(tree), -(-len(self._totals) // SCAN_BLOCK) + 1):
+                    tree.append(self._prefix_total(position - 1) -
+                                self._prefix_total(position - (position & -position)))
+
+    def _thaw(self):
+        """
+        It copies a graph opened by `load` out of the file into ordinary lists, dictionaries and arrays,
+        so that it can change
+        """
+        if isinstance(self._targets, array):
+            return
+        for name in ('_state_words', '_starts', '_degrees', '_totals', '_targets', '_counts'):
+            view = getattr(self, name)
+            copy = array(view.format)
+            copy.frombytes(view.cast('B'))
+            setattr(self, name, copy)
+        self.words = list(self.words)
+        self.word_ids = {word: index for index, word in enumerate(self.words)}
+        if self.order > 1:
+            self._state_ids = {self._state_key_of(index): index
+                               for index in range(len(self._state_words) // self.order)}
+
+    def _state_value(self, index):
+        """
+        It turns a state id back into the word or tuple of words it stands for
+
+        :param index: The id of the state
+        :return: The value of the state.
+        """
+        if self.order == 1:
+            return self.words[index]
+        start = index * self.order
+        return tuple(self.words[i] for i in self._state_words[start:start + self.order])
+
+    def _state_word(self, index):
+        """
+        It returns the last word of a state
+
+        :param index: The id of the state
+        :return: The word.
+        """
+        if self.order == 1:
+            return self.words[index]
+        return self.words[self._state_words[index * self.order + self.order - 1]]
+
+    def _row(self, index):
+        """
+        It yields the (target id, count) pairs of the edges leaving a vertex
+
+        :param index: The id of the vertex
+        """
+        if self._pending:
+            self._freeze()
+        if index >= len(self._degrees):
+            return
+        start = self._starts[index]
+        for slot in range(start, start + self._degrees[index]):
+            yield self._targets[slot], self._counts[slot]
+
+    def _set_edge(self, source, target, weight):
+        """
+        It makes the count of the edge from source to target equal to weight
+
+        :param source: The id of the vertex the edge leaves
+        :param target: The id of the vertex the edge goes to
+        :param weight: The new count of the edge
+        """
+        current = dict(self._row(source)).get(target, 0)
+        self._pending[source << 32 | target] = weight - current
+
+    def _freeze(self):
+        """
+        It merges the pending edge counts into the edge arrays. Every vertex that got new counts has its
+        row rewritten, either in place when it still fits or at the end of the arrays. If writing fails
+        (say an array cannot grow because a NumPy view of it is alive), the counts of the rows that were
+        not written go back into `_pending`, so the merge can be tried again.
+        """
+        if not self._pending:
+            return
+        self._thaw()
+        pending = self._pending
+        self._pending = {}
+        keys = sorted(pending)
+
+        i = first = 0
+        try:
+            self._add_rows()
+            while i < len(keys):
+                first = i
+                source = keys[i] >> 32
+                row = dict(self._row(source))
+                while i < len(keys) and keys[i] >> 32 == source:
+                    target = keys[i] & 0xFFFFFFFF
+                    row[target] = row.get(target, 0) + pending[keys[i]]
+                    i += 1
+                self._write_row(source, sorted(((t, c) for t, c in row.items() if c > 0), key=_by_count))
+        except BaseException:
+            self._pending = {key: pending[key] for key in keys[first:]}
+            raise
+
+        if self._garbage > len(self._targets) // 2:
+            self._compact()
+
+    def _write_row(self, source, row):
+        """
+        It stores the edges of a vertex in the edge arrays
+
+        :param source: The id of the vertex
+        :param row: A list of (target id, count) pairs, sorted by count, largest first
+        """
+        old_degree = self._degrees[source]
+        if len(row) <= old_degree:
+            start = self._starts[source]
+            self._garbage += old_degree - len(row)
+        else:
+            # after a write that failed half way one of the arrays can be longer than the other
+            start = min(len(self._targets), len(self._counts))
+            self._garbage += old_degree
+            _grow(self._targets, start + len(row))
+            _grow(self._counts, start + len(row))
+            self._starts[source] = start
+        total = 0
+        for offset, (target, count) in enumerate(row):
+            self._targets[start + offset] = target
+            self._counts[start + offset] = count
+            total += count
+        self._degrees[source] = len(row)
+        change = total - self._totals[source]
+        self._totals[source] = total
+        tree = self._tree
+        if tree is not None:
+            position = source // SCAN_BLOCK + 1
+            while position < len(tree):
+                tree[position] += change
+                position += position & -position
+        self._checkpoints.pop(source, None)
+
+    def _ready_checkpoints(self, index):
+        """
+        It works out the running totals of the blocks of SCAN_BLOCK slots of a row, but the last, and
+        keeps them until the row changes
+
+        :param index: The id of the vertex
+        :return: An array with the total of the row up to the end of each block.
+        """
+        start = self._starts[index]
+        end = start + self._degrees[index]
+        typecode = _total_type(self._count_type())
+        if typecode == 'Q' and self._totals[index] < 1 << 32:
+            typecode = 'I'
+        checkpoints = array(typecode)
+        total = 0
+        for block in range(start, end - SCAN_BLOCK, SCAN_BLOCK):
+            total += sum(self._counts[block:block + SCAN_BLOCK])
+            checkpoints.append(total)
+        self._checkpoints[index] = checkpoints
+        return checkpoints
+
+    def _compact(self):
+        """
+        It rewrites the edge arrays so that the rows sit back to back without unused slots between them.
+        """
+        targets = array('I')
+        counts = array(self._counts.typecode)
+        for index in range(len(self._degrees)):
+            start = self._starts[index]
+            end = start + self._degrees[index]
+            self._starts[index] = len(targets)
+            targets.extend(self._targets[start:end])
+            counts.extend(self._counts[start:end])
+        self._targets = targets
+        self._counts = counts
+        self._garbage = 0
+
+def _grow(values, length):
+    """
+    It pads an array with zeros up to a length, and leaves it alone if it is that long already
+    """
+    if length > len(values):
+        values.extend(array(values.typecode, bytes(values.itemsize * (length - len(values)))))
+
+def _total_type(count_type):
+    """
+    It returns the typecode that holds the total of many counts of a count type
+    """
+    return 'd' if count_type in 'fd' else 'Q'
+
+def _by_count(edge):
+    """
+    The sort key that puts the edges of a row in order of count, largest first, and of target id among
+    equal counts
+    """
+    return -edge[1], edge[0]
+
+# _MappedWords is the read-only list of words of a graph opened by Graph.load. The words stay in the
+# file as one block of UTF-8 and a word is only decoded when it is asked for
+class _MappedWords:
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1]], 'utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+# _MappedIndex is the read-only dictionary from a key to an id of a graph opened by Graph.load. It
+# keeps only the ids sorted by their keys and finds a key by binary search
+class _MappedIndex:
+    def __init__(self, sorted_ids, key_of):
+        self.sorted_ids = sorted_ids
+        self.key_of = key_of
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+    def __iter__(self):
+        for index in self.sorted_ids:
+            yield self.key_of(index)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        index = self.get(key)
+        if index is None:
+            raise KeyError(key)
+        return index
 
+    def get(self, key, default=None):
+        position = bisect_left(self.sorted_ids, key, key=self.key_of)
+        if position < len(self.sorted_ids):
+            index = self.sorted_ids[position]
+            if self.key_of(index) == key:
+                return index
+        return default
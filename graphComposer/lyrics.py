@@ -1,17 +1,209 @@
-import lyricsgenius
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
 
 # generate an api key and paste it
 # https://genius.com/api-clients
-genius = lyricsgenius.Genius("api-key-here")
-
-def save_lyrics(songs, artist_name, album_name):
-    for i in range(len(songs
-    )):
-        song_title = songs[i]
-        song = genius.search_song(song_title, artist_name)
-        lyrics = song.lyrics
-        with open('songs/{}/{}_{}_{}.txt'.format('_'.join(artist_name.split(' ')), i+1, album_name, '-'.join(''.join(song_title.split('\'')).split(' '))), 'w') as f:
+GENIUS_API_KEY = "api-key-here"
+
+# The GeniusBackend class fetches lyrics from the Genius API through lyricsgenius
+class GeniusBackend:
+    name = 'genius'
+
+    def __init__(self, api_key=GENIUS_API_KEY):
+        import lyricsgenius
+        self.genius = lyricsgenius.Genius(api_key)
+
+    def fetch(self, song_title, artist_name):
+        """
+        It searches Genius for a song and returns its lyrics
+
+        :param song_title: the title of the song
+        :param artist_name: the artist of the song
+        :return: The lyrics as a string
+        """
+        song = self.genius.search_song(song_title, artist_name)
+        if song is None:
+            raise LookupError(f'{song_title!r} by {artist_name!r} was not found')
+        return song.lyrics
+
+# The HttpBackend class fetches lyrics with a GET request to `<base_url>/lyrics?title=...&artist=...`,
+# for example from a local stub server when we test without the network
+class HttpBackend:
+    name = 'http'
+
+    def __init__(self, base_url, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def fetch(self, song_title, artist_name):
+        """
+        It asks the server for the lyrics of a song
+
+        :param song_title: the title of the song
+        :param artist_name: the artist of the song
+        :return: The lyrics as a string
+        """
+        url = f'{self.base_url}/lyrics?' + urlencode({'title': song_title, 'artist': artist_name})
+        try:
+            with urlopen(url, timeout=self.timeout) as response:
+                return response.read().decode('utf-8')
+        except HTTPError as error:
+            if error.code == 404:
+                raise LookupError(f'{song_title!r} by {artist_name!r} was not found') from error
+            raise
+
+# The TokenBucket class limits how many requests start per second. It holds up to `capacity` tokens,
+# refills at `rate` tokens per second, and every request takes one token, waiting if there is none
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        It takes one token, sleeping until one is available
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# The ResponseCache class keeps the raw responses on disk, content addressed: every response is stored
+# once under the SHA-256 of its content in `objects/`, and `refs/` maps the hash of a request (backend,
+# artist and title) to the hash of its response
+class ResponseCache:
+    def __init__(self, directory='.lyrics_cache'):
+        self.directory = directory
+
+    def get(self, request):
+        """
+        It returns the cached response to a request, or None
+
+        :param request: a list of the strings that identify the request
+        :return: The response as a string, or None
+        """
+        try:
+            with open(self._ref_path(request)) as f:
+                content_hash = f.read().strip()
+            with open(os.path.join(self.directory, 'objects', content_hash), 'rb') as f:
+                return f.read().decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def put(self, request, response):
+        """
+        It stores the response to a request
+
+        :param request: a list of the strings that identify the request
+        :param response: the response as a string
+        """
+        content = response.encode('utf-8')
+        content_hash = hashlib.sha256(content).hexdigest()
+        self._write(os.path.join(self.directory, 'objects', content_hash), content)
+        self._write(self._ref_path(request), content_hash.encode())
+
+    def _ref_path(self, request):
+        key = hashlib.sha256(json.dumps(request).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'refs', key)
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+def fetch_with_retry(backend, song_title, artist_name, bucket=None, retries=4, backoff=0.5):
+    """
+    > Fetch the lyrics of a song, waiting for the rate limiter before every attempt and retrying with
+    exponential backoff (plus some jitter) when the attempt fails with anything but "not found"
+
+    :param backend: the backend to fetch with
+    :param song_title: the title of the song
+    :param artist_name: the artist of the song
+    :param bucket: a TokenBucket to respect, if any (optional)
+    :param retries: how many times to try again after a failure, defaults to 4 (optional)
+    :param backoff: the wait before the first retry in seconds, doubled after each retry, defaults to
+    0.5 (optional)
+    :return: The lyrics as a string
+    """
+    for attempt in range(retries + 1):
+        if bucket:
+            bucket.acquire()
+        try:
+            return backend.fetch(song_title, artist_name)
+        except LookupError:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+def song_path(song_title, artist_name, album_name, track):
+    """
+    It returns the file a song's lyrics are saved to in `songs/`
+
+    :param song_title: the title of the song
+    :param artist_name: the artist of the song
+    :param album_name: the album of the song
+    :param track: the number of the song in the list
+    :return: The path of the file
+    """
+    return 'songs/{}/{}_{}_{}.txt'.format('_'.join(artist_name.split(' ')), track, album_name,
+                                          '-'.join(''.join(song_title.split('\'')).split(' ')))
+
+def save_lyrics(songs, artist_name, album_name, backend=None, workers=8, rate=5.0,
+                cache=ResponseCache(), retries=4):
+    """
+    > Fetch the lyrics of a list of songs on a pool of threads and save each one to `songs/`. At most
+    `workers` requests are in flight and at most `rate` start per second. Responses already in the
+    cache are not fetched again, so a crawl that was interrupted picks up where it stopped
+
+    :param songs: the titles of the songs
+    :param artist_name: the artist of the songs
+    :param album_name: the album of the songs
+    :param backend: the backend to fetch with, defaults to GeniusBackend() (optional)
+    :param workers: the number of requests in flight at once, defaults to 8 (optional)
+    :param rate: the most requests started per second, defaults to 5 (optional)
+    :param cache: the ResponseCache to use, or None to always fetch (optional)
+    :param retries: how many times to retry a failed request, defaults to 4 (optional)
+    :return: The paths of the files that were written
+    """
+    backend = backend or GeniusBackend()
+    bucket = TokenBucket(rate)
+
+    def save(track, song_title):
+        request = [backend.name, artist_name, song_title]
+        lyrics = cache.get(request) if cache else None
+        if lyrics is None:
+            lyrics = fetch_with_retry(backend, song_title, artist_name, bucket, retries)
+            if cache:
+                cache.put(request, lyrics)
+        path = song_path(song_title, artist_name, album_name, track)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
             f.writelines(lyrics.split('\\n'))
+        return path
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(save, range(1, len(songs) + 1), songs))
 
 
 if __name__ == '__main__':
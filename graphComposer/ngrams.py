@@ -0,0 +1,131 @@
+import os
+import sqlite3
+from compose import iter_words_from_text, tokenize_line
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    gram TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    PRIMARY KEY (gram, file_id, offset)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_by_file ON postings (file_id);
+'''
+
+# The NgramIndex class keeps an inverted index of the songs in a SQLite file: for every word and every
+# run of up to `max_n` words, the files it appears in and its word offsets there (offsets count the
+# words `iter_words_from_text` gives, so they line up with what the graph was built from). The postings
+# are clustered by n-gram, so a lookup is one B-tree search. A file is indexed again only when its
+# size or mtime changed, and the postings of files that are gone are dropped
+class NgramIndex:
+    def __init__(self, path=os.path.join('.graph_cache', 'ngrams.sqlite'), max_n=2):
+        """
+        :param path: the SQLite file, defaults to '.graph_cache/ngrams.sqlite' (optional)
+        :param max_n: the longest n-gram to index, defaults to 2 (optional)
+        """
+        self.path = path
+        self.max_n = max_n
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def update(self, paths):
+        """
+        > Bring the index up to date with a list of files: files that are new or whose size or mtime
+        changed are (re)indexed, the others are left alone, and the files of the index that no longer
+        exist are removed
+
+        :param paths: the files to index
+        :return: The number of files that were (re)indexed
+        """
+        db = self.connection
+        known = {path: (file_id, size, mtime_ns)
+                 for file_id, path, size, mtime_ns in db.execute('SELECT id, path, size, mtime_ns FROM files')}
+        indexed = 0
+        with db:
+            for path, (file_id, _, _) in known.items():
+                if not os.path.exists(path):
+                    self._remove(file_id)
+            for path in paths:
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry and entry[1:] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                if entry:
+                    self._remove(entry[0])
+                file_id = db.execute('INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)',
+                                     (path, stat.st_size, stat.st_mtime_ns)).lastrowid
+                db.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?, ?)',
+                               self._postings(file_id, iter_words_from_text(path)))
+                indexed += 1
+        return indexed
+
+    def remove(self, paths):
+        """
+        It drops files from the index
+        :param paths: the files to drop
+        """
+        db = self.connection
+        with db:
+            for path in paths:
+                row = db.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()
+                if row:
+                    self._remove(row[0])
+
+    def lookup(self, ngram):
+        """
+        It finds every place an n-gram appears
+        :param ngram: a string of up to `max_n` words, tokenized like the songs are
+        :return: A list of (path, word offset) pairs, in path and offset order
+        """
+        gram = self._gram(ngram)
+        return self.connection.execute(
+            'SELECT files.path, postings.offset FROM postings JOIN files ON files.id = postings.file_id '
+            'WHERE postings.gram = ? ORDER BY files.path, postings.offset', (gram,)).fetchall()
+
+    def files_containing(self, ngram):
+        """
+        It lists the files an n-gram appears in
+        :param ngram: a string of up to `max_n` words, tokenized like the songs are
+        :return: A sorted list of paths
+        """
+        gram = self._gram(ngram)
+        return [path for path, in self.connection.execute(
+            'SELECT DISTINCT files.path FROM postings JOIN files ON files.id = postings.file_id '
+            'WHERE postings.gram = ? ORDER BY files.path', (gram,))]
+
+    def _gram(self, ngram):
+        words = tokenize_line(ngram)
+        if not 1 <= len(words) <= self.max_n:
+            raise ValueError(f'The index holds n-grams of 1 to {self.max_n} words, got {len(words)}')
+        return ' '.join(words)
+
+    def _postings(self, file_id, words):
+        window = []
+        for offset, word in enumerate(words):
+            window.append(word)
+            if len(window) > self.max_n:
+                window.pop(0)
+            for n in range(1, len(window) + 1):
+                yield ' '.join(window[-n:]), file_id, offset - n + 1
+
+    def _remove(self, file_id):
+        self.connection.execute('DELETE FROM postings WHERE file_id = ?', (file_id,))
+        self.connection.execute('DELETE FROM files WHERE id = ?', (file_id,))
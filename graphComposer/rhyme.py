@@ -0,0 +1,227 @@
+import random
+import re
+import numpy as np
+from batch import edge_arrays
+from blend import edge_list
+
+VOWEL_GROUP = re.compile(r'[aeiouy]+')
+
+def syllable_count(word):
+    """
+    It guesses the number of syllables of a word from its groups of vowels, not counting a silent "e"
+    at the end ("time", but not "little")
+
+    :param word: a lowercase word
+    :return: The number of syllables, at least 1
+    """
+    groups = VOWEL_GROUP.findall(word)
+    count = len(groups)
+    if count > 1 and word.endswith('e') and groups[-1] == 'e' and not word.endswith('le'):
+        count -= 1
+    return max(count, 1)
+
+def rhyme_key(word):
+    """
+    It guesses the part of a word that a rhyme has to match: the word from its last sounded group of
+    vowels on ("night" -> "ight", "time" -> "ime")
+
+    :param word: a lowercase word
+    :return: The rhyme key
+    """
+    groups = list(VOWEL_GROUP.finditer(word))
+    if not groups:
+        return word
+    last = groups[-1]
+    if len(groups) > 1 and last.group() == 'e' and last.end() == len(word):
+        last = groups[-2]
+    return word[last.start():]
+
+# The RhymeIndex class indexes the words of a graph by rhyme key and by syllable count, and works out
+# which states can still finish a line under a constraint. For a line of `budget` syllables (or words)
+# that ends on one of a set of words, reachable(...)[s, v] says whether some walk from state v emits
+# words worth exactly s syllables with the last one in the set. The table is filled in for s = 1 ..
+# budget with one pass over all the edges each, so it costs O(budget * edges) once per constraint, and
+# it is kept so the next line with the same constraint costs nothing to set up
+class RhymeIndex:
+    def __init__(self, g, max_tables=64):
+        """
+        :param g: the graph
+        :param max_tables: how many reachability tables to keep, defaults to 64 (optional)
+        """
+        self.g = g
+        self.syllables = np.array([syllable_count(word) for word in g.words], dtype=np.int64)
+        self.rhymes = {}
+        for index, word in enumerate(g.words):
+            self.rhymes.setdefault(rhyme_key(word), []).append(index)
+        self.by_syllables = {}
+        for index, count in enumerate(self.syllables.tolist()):
+            self.by_syllables.setdefault(count, []).append(index)
+        self.max_tables = max_tables
+        self.tables = {}
+
+        # copies, not views of the graph's arrays, so the graph can still be updated while the index
+        # is alive (the index keeps describing the graph as it was when it was made)
+        self.starts, self.degrees, _, slot_counts = edge_arrays(g)
+        self.slot_counts = slot_counts.astype(np.float64)
+        self.sources, self.targets, counts = edge_list(g)
+        self.start_weights = np.bincount(self.sources, weights=counts, minlength=len(self.degrees))
+        if g.order == 1:
+            self.last_words = np.arange(len(g.words))
+        else:
+            self.last_words = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, g.order)[:, -1].astype(np.int64)
+        self.edge_targets = np.frombuffer(g._targets, dtype=np.uint32).astype(np.int64)
+
+    def rhymes_with(self, word):
+        """
+        It lists the words of the graph with the same rhyme key as a word
+        :param word: a word
+        :return: A list of words
+        """
+        return [self.g.words[index] for index in self.rhymes.get(rhyme_key(word), [])]
+
+    def words_with_syllables(self, count):
+        """
+        It lists the words of the graph with a number of syllables
+        :param count: the number of syllables
+        :return: A list of words
+        """
+        return [self.g.words[index] for index in self.by_syllables.get(count, [])]
+
+    def costs(self, count_syllables):
+        """
+        It returns what emitting each state's last word takes from the budget
+        :param count_syllables: whether the budget is in syllables (True) or in words (False)
+        :return: An array with the cost of every state
+        """
+        if count_syllables:
+            return self.syllables[self.last_words]
+        return np.ones(len(self.last_words), dtype=np.int64)
+
+    def end_mask(self, rhyme):
+        """
+        It marks the states whose last word may end the line
+        :param rhyme: a rhyme key, or None to let any word end the line
+        :return: An array of booleans, one per state
+        """
+        if rhyme is None:
+            return np.ones(len(self.last_words), dtype=bool)
+        ends = np.zeros(len(self.g.words), dtype=bool)
+        ends[self.rhymes.get(rhyme, [])] = True
+        return ends[self.last_words]
+
+    def reachable(self, budget, rhyme=None, count_syllables=True):
+        """
+        > Work out, for every remaining budget from 0 to `budget` and every state, whether a walk from
+        the state can spend exactly that budget and end on a word with the rhyme key
+
+        :param budget: the number of syllables (or words) of the line
+        :param rhyme: the rhyme key the last word must have, or None for any word (optional)
+        :param count_syllables: count the budget in syllables, or in words if False (optional)
+        :return: A (budget + 1, states) array of booleans
+        """
+        key = (budget, rhyme, count_syllables)
+        table = self.tables.pop(key, None)
+        if table is None:
+            cost = self.costs(count_syllables)[self.targets]
+            ends = self.end_mask(rhyme)[self.targets]
+            states = len(self.last_words)
+            table = np.zeros((budget + 1, states), dtype=bool)
+            for remaining in range(1, budget + 1):
+                rest = remaining - cost
+                ok = (rest == 0) & ends
+                going = rest > 0
+                ok[going] = table[rest[going], self.targets[going]]
+                table[remaining] = np.bincount(self.sources[ok], minlength=states) > 0
+            if len(self.tables) >= self.max_tables:
+                self.tables.pop(next(iter(self.tables)))
+        # kept in order of use, so the least recently used table is the first one
+        self.tables[key] = table
+        return table
+
+    def step(self, state, remaining, table, costs, ends, rng):
+        """
+        It draws the next state among the edges of a state that can still meet the constraint, each as
+        likely as its count
+        :return: The id of the next state
+        """
+        start, degree = self.starts[state], self.degrees[state]
+        targets = self.edge_targets[start:start + degree]
+        rest = remaining - costs[targets]
+        ok = ((rest == 0) & ends[targets]) | ((rest > 0) & table[np.maximum(rest, 0), targets])
+        totals = np.cumsum(np.where(ok, self.slot_counts[start:start + degree], 0), dtype=np.float64)
+        return int(targets[np.searchsorted(totals, rng.random() * totals[-1], side='right')])
+
+def walk_line(index, budget, rhyme, count_syllables, state, rng):
+    """
+    It walks the graph from a state (or a random one when state is None) until the budget is spent
+    :return: A tuple of (words, id of the last state), or None if no walk can meet the constraint
+    """
+    table = index.reachable(budget, rhyme, count_syllables)
+    costs = index.costs(count_syllables)
+    ends = index.end_mask(rhyme)
+    if state is None:
+        # a random state that can start the line, as likely as random_vertex would pick it
+        totals = np.cumsum(index.start_weights * table[budget])
+        if not len(totals) or not totals[-1]:
+            return None
+        state = int(np.searchsorted(totals, rng.random() * totals[-1], side='right'))
+    elif not table[budget, state]:
+        return None
+
+    line = []
+    while budget:
+        state = index.step(state, budget, table, costs, ends, rng)
+        line.append(index.g.words[index.last_words[state]])
+        budget -= costs[state]
+    return line, state
+
+def compose_line(index, syllables=None, rhyme=None, length=8, after=None, rng=None):
+    """
+    > Compose one line that has exactly `syllables` syllables (or `length` words when syllables is
+    None) and ends on a word with the rhyme key `rhyme`. Each step only draws among the transitions
+    that can still meet the constraint, so a line takes one draw per word and never has to start over
+
+    :param index: the RhymeIndex of the graph
+    :param syllables: the number of syllables of the line, or None to count words instead (optional)
+    :param rhyme: the rhyme key the line must end on, see rhyme_key, or None for any word (optional)
+    :param length: the number of words of the line when syllables is None, defaults to 8 (optional)
+    :param after: the Vertex the line carries on from, like the end of the line before, or None to
+    start from a random state (optional)
+    :param rng: the generator to draw with, anything with a `random()` method, defaults to the random
+    module (optional)
+    :return: A list of words, or None if no walk can meet the constraint
+    """
+    count_syllables = syllables is not None
+    walk = walk_line(index, syllables if count_syllables else length, rhyme, count_syllables,
+                     None if after is None else after.index, rng or random)
+    return None if walk is None else walk[0]
+
+def compose_verse(index, scheme='ABAB', syllables=8, rng=None):
+    """
+    > Compose a verse of lines that rhyme by a scheme like 'ABAB' or 'AABB': the first line of each
+    letter ends on any word, and the later lines of the letter end on a word that rhymes with it. Every
+    line carries on from the end of the line before
+
+    :param index: the RhymeIndex of the graph
+    :param scheme: one letter per line, lines with the same letter rhyme, defaults to 'ABAB' (optional)
+    :param syllables: the number of syllables of every line, defaults to 8 (optional)
+    :param rng: the generator to draw with, defaults to the random module (optional)
+    :return: A list of lines, each a list of words
+    """
+    rng = rng or random
+    rhymes = {}
+    lines = []
+    state = None
+    for letter in scheme:
+        walk = walk_line(index, syllables, rhymes.get(letter), True, state, rng)
+        if walk is None and state is not None:
+            # nothing rhymes from where the last line ended, so this line starts afresh
+            walk = walk_line(index, syllables, rhymes.get(letter), True, None, rng)
+        if walk is None and letter not in rhymes:
+            raise ValueError(f'The graph has no line of {syllables} syllables')
+        if walk is None:
+            raise ValueError(f'No line of {syllables} syllables can end on the rhyme {rhymes[letter]!r}')
+        line, state = walk
+        rhymes.setdefault(letter, rhyme_key(line[-1]))
+        lines.append(line)
+    return lines
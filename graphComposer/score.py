@@ -0,0 +1,141 @@
+import math
+import numpy as np
+from blend import edge_list
+
+# The Scorer class scores texts against a graph in bulk. It maps the tokens to word ids with one dict
+# lookup each, finds the state before every token and looks up the transitions in a sorted array of
+# edge keys (source * words + target word) with one np.searchsorted, so the per-token work is a handful
+# of NumPy operations. Probabilities use add-alpha smoothing over the vocabulary, so a transition the
+# graph never saw costs a lot but is not impossible. A token the graph does not know is read as `unk`
+# (see compact.compact_graph) when the graph has it, and as one more word of the vocabulary otherwise
+class Scorer:
+    def __init__(self, g, alpha=1.0, unk='<unk>'):
+        """
+        :param g: the graph
+        :param alpha: the smoothing constant, added to the count of every transition, defaults to 1
+        (optional)
+        :param unk: the word that stands for unknown words, defaults to '<unk>' (optional)
+        """
+        self.g = g
+        self.order = g.order
+        self.alpha = alpha
+        self.word_ids = g.word_ids
+        self.unk_id = g.word_ids.get(unk, -1)
+        words = len(g.words)
+        self.vocabulary = words + (self.unk_id < 0)
+
+        sources, targets, counts = edge_list(g)
+        if self.order == 1:
+            rows = np.arange(words).reshape(-1, 1)
+        else:
+            rows = np.frombuffer(g._state_words, dtype=np.uint32).reshape(-1, self.order).astype(np.int64)
+        self.totals = np.bincount(sources, weights=counts, minlength=len(rows))
+        # a state can have more than one edge to states with the same last word (after compaction the
+        # unk states do), and those all count for the same next word
+        self.keys, inverse = np.unique(sources * words + rows[targets, -1], return_inverse=True)
+        self.counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(self.keys))
+
+        # a state of k words is found one word at a time: the id of its first j words and its next word
+        # make a key that is looked up among the sorted keys of the (j + 1)-word prefixes of all states
+        self.prefix_keys = []
+        prefix = rows[:, 0]
+        for column in range(1, self.order):
+            keys, prefix = np.unique(prefix * words + rows[:, column], return_inverse=True)
+            self.prefix_keys.append(keys)
+            prefix = prefix.reshape(-1)
+        # the states in the order of their prefix ids
+        self.prefix_states = np.empty(len(rows), dtype=np.int64)
+        self.prefix_states[prefix] = np.arange(len(rows))
+
+    def ids(self, tokens):
+        """
+        It maps tokens to word ids
+        :param tokens: a list of words
+        :return: An array of word ids, with `unk`'s id (or -1) for the words the graph does not know
+        """
+        get = self.word_ids.get
+        unk_id = self.unk_id
+        return np.fromiter((get(token, unk_id) for token in tokens), dtype=np.int64, count=len(tokens))
+
+    def states(self, ids):
+        """
+        It finds the state made of every `order` consecutive word ids
+        :param ids: an array of word ids
+        :return: An array with the state id of ids[i:i + order] at i, or -1 where there is no such state
+        """
+        words = len(self.g.words)
+        count = len(ids) - self.order + 1
+        if count <= 0:
+            return np.empty(0, dtype=np.int64)
+        prefix = ids[:count].copy()
+        known = prefix >= 0
+        for column, keys in enumerate(self.prefix_keys, 1):
+            key = prefix * words + ids[column:column + count]
+            position = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            known &= (ids[column:column + count] >= 0) & (keys[position] == key)
+            prefix = position
+        return np.where(known, self.prefix_states[np.where(known, prefix, 0)], -1)
+
+    def log_probs(self, tokens):
+        """
+        It works out the smoothed log probability of every transition of a text
+        :param tokens: a list of words, or an array of word ids
+        :return: An array with the natural log probability of tokens[i + order] after the words before it
+        """
+        ids = tokens if isinstance(tokens, np.ndarray) else self.ids(tokens)
+        sources = self.states(ids[:-1])
+        targets = ids[self.order:]
+        known = (sources >= 0) & (targets >= 0)
+        key = np.where(known, sources, 0) * len(self.g.words) + np.where(known, targets, 0)
+        counts = 0
+        if len(self.keys):
+            position = np.minimum(np.searchsorted(self.keys, key), len(self.keys) - 1)
+            counts = np.where(known & (self.keys[position] == key), self.counts[position], 0)
+        totals = np.where(sources >= 0, self.totals[np.maximum(sources, 0)], 0)
+        return np.log(counts + self.alpha) - np.log(totals + self.alpha * self.vocabulary)
+
+    def score(self, tokens):
+        """
+        It scores a text
+        :param tokens: a list of words
+        :return: A dictionary with the log likelihood, the number of transitions scored and the
+        perplexity
+        """
+        log_probs = self.log_probs(tokens)
+        return summary(float(log_probs.sum()), len(log_probs))
+
+    def score_many(self, texts):
+        """
+        > Score many texts, like N candidate compositions, in one pass: the texts are joined into one
+        array, and the transitions that would cross from one text into the next are left out
+
+        :param texts: a list of lists of words
+        :return: A list with the score (see score) of every text
+        """
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        ids = self.ids([token for text in texts for token in text])
+        log_probs = self.log_probs(ids)
+        # transition i predicts token i + order, which belongs to the same text as token i when the
+        # text has room for it
+        ends = np.cumsum(lengths)
+        owner = np.searchsorted(ends, np.arange(len(log_probs)), side='right')
+        inside = np.arange(len(log_probs)) + self.order < ends[np.minimum(owner, len(ends) - 1)]
+        sums = np.bincount(owner[inside], weights=log_probs[inside], minlength=len(texts))
+        transitions = np.maximum(lengths - self.order, 0)
+        return [summary(float(total), int(n)) for total, n in zip(sums, transitions)]
+
+    def perplexity(self, tokens):
+        """
+        It returns the perplexity of a text
+        :param tokens: a list of words
+        :return: The perplexity
+        """
+        return self.score(tokens)['perplexity']
+
+def summary(log_likelihood, transitions):
+    """
+    It puts a log likelihood, its number of transitions and the perplexity they give in a dictionary
+    :return: A dictionary
+    """
+    perplexity = math.exp(-log_likelihood / transitions) if transitions else float('inf')
+    return {'log_likelihood': log_likelihood, 'transitions': transitions, 'perplexity': perplexity}
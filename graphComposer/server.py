@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+from batch import BatchSampler
+from compose import graph_cache, ingest, song_files
+from dedupe import unique_paths
+from ngrams import NgramIndex
+
+# The Batcher class collects the composition requests for one graph that arrive close together and
+# answers them with one BatchSampler.sample call. The sampler is prepared once, when the server loads
+# the graph, so a batch only costs its own draws. Chains are independent, so one batch of the longest
+# requested length answers shorter requests too, by cutting their compositions short
+class Batcher:
+    def __init__(self, g, rng, window=0.002, max_batch=4096):
+        """
+        :param g: the graph to compose from
+        :param rng: the numpy.random.Generator for the batches
+        :param window: how long to wait for more requests after the first one, in seconds, defaults to
+        2 ms (optional)
+        :param max_batch: the most compositions in one batch, defaults to 4096 (optional)
+        """
+        self.g = g
+        self.sampler = BatchSampler(g)
+        self.rng = rng
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    async def compose(self, n, length):
+        """
+        It queues a request for n compositions and waits for them
+
+        :param n: the number of compositions
+        :param length: the length of each composition
+        :return: A list of n lists of words
+        """
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((n, length, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            total = requests[0][0]
+            deadline = loop.time() + self.window
+            while total < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                total += request[0]
+
+            try:
+                compositions = self.sampler.sample(total, None, max(length for _, length, _ in requests),
+                                                   self.rng)
+            except Exception as error:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            position = 0
+            for n, length, future in requests:
+                if not future.done():
+                    future.set_result([words[:length] for words in compositions[position:position + n]])
+                position += n
+
+# The CompositionServer class answers HTTP requests for compositions from graphs it loads once at
+# startup:
+#   GET /compose?artist=queen&length=100&n=1  ->  {"artist": ..., "compositions": ["...", ...]}
+#   GET /stats                                ->  request count and latency percentiles in ms
+#   GET /health                               ->  {"status": "ok", "artists": [...]}
+# Connections are kept alive, so a client can send many requests over one connection
+class CompositionServer:
+    def __init__(self, graphs, seed=None, window=0.002, max_batch=4096, max_length=1000, max_n=1000,
+                 latency_samples=100000):
+        """
+        :param graphs: a dictionary that maps artist names to graphs
+        :param seed: a seed for the random numbers, for reproducible runs (optional)
+        :param window: how long a batch waits for more requests, in seconds, defaults to 2 ms (optional)
+        :param max_batch: the most compositions in one batch, defaults to 4096 (optional)
+        :param max_length: the longest composition a request may ask for, defaults to 1000 (optional)
+        :param max_n: the most compositions a request may ask for, defaults to 1000 (optional)
+        :param latency_samples: how many of the latest request latencies to keep, defaults to 100000
+        (optional)
+        """
+        rngs = np.random.SeedSequence(seed).spawn(len(graphs))
+        self.batchers = {artist: Batcher(g, np.random.default_rng(rng), window, max_batch)
+                         for (artist, g), rng in zip(graphs.items(), rngs)}
+        self.max_length = max_length
+        self.max_n = max_n
+        self.latencies = deque(maxlen=latency_samples)
+        self.requests = 0
+
+    def stats(self):
+        """
+        It works out the latency percentiles of the latest requests
+        :return: A dictionary with the request count and the p50, p90, p99 and max latency in ms
+        """
+        if not self.latencies:
+            return {'requests': self.requests}
+        p50, p90, p99, p100 = np.percentile(np.array(self.latencies) * 1000, [50, 90, 99, 100])
+        return {'requests': self.requests, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'max_ms': p100}
+
+    async def handle(self, path):
+        """
+        It answers one request
+
+        :param path: the path and query of the request
+        :return: A tuple of (HTTP status, JSON-able body)
+        """
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        if url.path == '/compose':
+            artist = query.get('artist', [''])[0]
+            if artist not in self.batchers:
+                return 404, {'error': f'unknown artist {artist!r}'}
+            try:
+                length = int(query.get('length', ['100'])[0])
+                n = int(query.get('n', ['1'])[0])
+            except ValueError:
+                return 400, {'error': 'length and n must be integers'}
+            if not 1 <= length <= self.max_length or not 1 <= n <= self.max_n:
+                return 400, {'error': f'length must be 1-{self.max_length} and n 1-{self.max_n}'}
+            compositions = await self.batchers[artist].compose(n, length)
+            return 200, {'artist': artist, 'compositions': [' '.join(words) for words in compositions]}
+        if url.path == '/stats':
+            return 200, self.stats()
+        if url.path == '/health':
+            return 200, {'status': 'ok', 'artists': sorted(self.batchers)}
+        return 404, {'error': 'not found'}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+                        keep_alive = False
+
+                start = time.perf_counter()
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, body = 400, {'error': 'bad request'}
+                    keep_alive = False
+                elif parts[0] != 'GET':
+                    status, body = 405, {'error': 'only GET is supported'}
+                else:
+                    status, body = await self.handle(parts[1])
+                payload = json.dumps(body).encode()
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                             b'Connection: %s\r\n\r\n' % (status, b'OK' if status == 200 else b'Error',
+                                                          len(payload), b'keep-alive' if keep_alive else b'close'))
+                writer.write(payload)
+                await writer.drain()
+                self.requests += 1
+                self.latencies.append(time.perf_counter() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_path=None):
+        """
+        It listens on a TCP port, or on a Unix socket when unix_path is given, until it is cancelled
+
+        :param host: the address to listen on, defaults to 127.0.0.1 (optional)
+        :param port: the port to listen on, defaults to 8000 (optional)
+        :param unix_path: the path of a Unix socket to listen on instead (optional)
+        """
+        if unix_path:
+            server = await asyncio.start_unix_server(self.serve_connection, unix_path)
+        else:
+            server = await asyncio.start_server(self.serve_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+def load_graphs(artists, order=1, index=None):
+    """
+    It loads (or builds, the first time) the graph of every artist through the graph cache, leaving
+    out the songs that repeat an earlier one, and brings the n-gram index of their songs up to date
+
+    :param artists: the artists to load
+    :param order: the order of the graphs, defaults to 1 (optional)
+    :param index: the NgramIndex to update, defaults to the one in '.graph_cache' (optional)
+    :return: A dictionary that maps artist names to graphs
+    """
+    ngram_index = index or NgramIndex()
+    graphs = {}
+    for artist in artists:
+        paths = unique_paths(song_files(artist))
+        graphs[artist] = graph_cache.get_graph(paths, order, ingest)
+        ngram_index.update(paths)
+    if index is None:
+        ngram_index.close()
+    return graphs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve compositions over HTTP.')
+    parser.add_argument('artists', nargs='*', help='the artists to load, defaults to every one in songs/')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--order', type=int, default=1)
+    parser.add_argument('--seed', type=int)
+    arguments = parser.parse_args()
+
+    artists = arguments.artists or sorted(name for name in os.listdir('songs') if name != '.DS_Store')
+    server = CompositionServer(load_graphs(artists, arguments.order), arguments.seed)
+    print(f'serving {len(artists)} artists on {arguments.unix or f"http://{arguments.host}:{arguments.port}"}')
+    asyncio.run(server.serve(arguments.host, arguments.port, arguments.unix))
@@ -2,11 +2,15 @@ import numpy as np
 import imageProcessing.png as png
 
 class Image:
-    def __init__(self, x_pixels=0, y_pixels=0, num_channels=0, filename=''):
+    def __init__(self, x_pixels=0, y_pixels=0, num_channels=0, filename='', array=None):
         # you need to input either filename OR x_pixels, y_pixels, and num_channels
+        # (or an existing 3D array for the image to use as is, without copying it)
         self.input_path = 'input/'
         self.output_path = 'output/'
-        if x_pixels and y_pixels and num_channels:
+        if array is not None:
+            self.array = array
+            self.x_pixels, self.y_pixels, self.num_channels = self.array.shape
+        elif x_pixels and y_pixels and num_channels:
             self.x_pixels = x_pixels
             self.y_pixels = y_pixels
             self.num_channels = num_channels